@@ -3,12 +3,16 @@ from typing import Dict, List, Any, Set
 import random
 
 def find_nearest_idle_driver(source, drivers, graph: Graph):
-    best, best_dist = None, float('inf')
-    for d in [x for x in drivers if x['status'] == 'idle']:
-        dist = graph.dijkstra(d['location'], source)['distance']
-        if dist < best_dist:
-            best, best_dist = d, dist
-    return {'best_driver': best, 'min_pickup_dist': best_dist}
+    idle_at: Dict[str, Dict[str, Any]] = {}
+    for d in drivers:
+        if d['status'] == 'idle':
+            idle_at.setdefault(d['location'], d)
+    # roads are undirected, so the first idle driver reached from the pickup is the nearest one
+    hit = graph.nearest_targets(source, idle_at, k=1)
+    if not hit:
+        return {'best_driver': None, 'min_pickup_dist': float('inf')}
+    node, dist = hit[0]
+    return {'best_driver': idle_at[node], 'min_pickup_dist': dist}
 
 def find_best_pool_option(driver, request, graph: Graph):
     all_passengers = driver['passengers'] + [request]
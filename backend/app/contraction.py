@@ -0,0 +1,232 @@
+"""Contraction hierarchies for the road graphs built by Graph (artifacts: python -m app.contraction)."""
+import argparse
+import hashlib
+import heapq
+import json
+from array import array
+from typing import Dict, List, Tuple
+
+MAGIC = b'CARPOOL-CH 1\n'
+INF = float('inf')
+
+
+def graph_fingerprint(compiled) -> str:
+    """Hash of a frozen graph's CSR arrays, used to reject artifacts built for another graph."""
+    ids, _, offsets, targets, weights = compiled
+    digest = hashlib.sha1(json.dumps(ids).encode())
+    for arr in (array('q', offsets), array('q', targets), array('d', weights)):
+        digest.update(arr.tobytes())
+    return digest.hexdigest()
+
+
+class ContractionHierarchy:
+    # nodes are contracted cheapest edge difference first; shortcuts remember the node they bypass, so queries
+    # only search upward in rank from both ends and paths are unpacked afterwards
+    WITNESS_SETTLE_LIMIT = 64  # witness searches give up after this many nodes (costs extra shortcuts, never correctness)
+
+    def __init__(self, ids: List[str], rank: array, offsets: array, targets: array, weights: array,
+                 middles: array, fingerprint: str = ''):
+        self.ids = ids
+        self.index = {node: i for i, node in enumerate(ids)}
+        self.rank = rank
+        # upward edges in CSR form: node i reaches higher-ranked targets[offsets[i]:offsets[i + 1]];
+        # middles holds the contracted node a shortcut bypasses, or -1 for an original road
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+        self.middles = middles
+        self.fingerprint = fingerprint
+
+    @property
+    def shortcut_count(self) -> int:
+        return sum(1 for m in self.middles if m != -1)
+
+    @classmethod
+    def build(cls, graph) -> 'ContractionHierarchy':
+        compiled = graph.freeze()
+        ids, _, offsets, targets, weights = compiled
+        n = len(ids)
+        # remaining (uncontracted) graph: node -> {neighbour: (weight, middle)}, parallel roads collapsed
+        adj: List[Dict[int, Tuple[float, int]]] = [{} for _ in range(n)]
+        for u in range(n):
+            for e in range(offsets[u], offsets[u + 1]):
+                v, w = targets[e], weights[e]
+                if v != u and w < adj[u].get(v, (INF,))[0]:
+                    adj[u][v] = (w, -1)
+        contracted_neighbours = [0] * n
+        up: List[List[Tuple[int, float, int]]] = [[] for _ in range(n)]
+        rank = array('q', [0]) * n
+
+        def shortcuts(v: int, apply: bool) -> int:
+            neighbours = list(adj[v].items())
+            added = 0
+            for i, (u, (wu, _)) in enumerate(neighbours):
+                via = {w: wu + ww for w, (ww, _) in neighbours[i + 1:]}
+                if not via:
+                    continue
+                witness = cls._witness(adj, u, v, max(via.values()), set(via))
+                for w, d in via.items():
+                    if witness.get(w, INF) <= d:
+                        continue
+                    added += 1
+                    if apply and d < adj[u].get(w, (INF,))[0]:
+                        adj[u][w] = adj[w][u] = (d, v)
+            return added
+
+        def priority(v: int) -> int:
+            return shortcuts(v, False) - len(adj[v]) + contracted_neighbours[v]
+
+        heap = [(priority(v), v) for v in range(n)]
+        heapq.heapify(heap)
+        order = 0
+        while heap:
+            _, v = heapq.heappop(heap)
+            current = priority(v)
+            if heap and current > heap[0][0]:
+                heapq.heappush(heap, (current, v))  # lazy update: someone else is cheaper now
+                continue
+            shortcuts(v, True)
+            for u, (w, middle) in adj[v].items():
+                up[v].append((u, w, middle))
+                del adj[u][v]
+                contracted_neighbours[u] += 1
+            adj[v] = {}
+            rank[v] = order
+            order += 1
+
+        up_offsets, up_targets, up_weights, up_middles = array('q', [0]), array('q'), array('d'), array('q')
+        for edges in up:
+            for u, w, middle in edges:
+                up_targets.append(u)
+                up_weights.append(w)
+                up_middles.append(middle)
+            up_offsets.append(len(up_targets))
+        return cls(list(ids), rank, up_offsets, up_targets, up_weights, up_middles, graph_fingerprint(compiled))
+
+    @classmethod
+    def _witness(cls, adj, source: int, skip: int, limit: float, wanted: set) -> Dict[int, float]:
+        distances = {source: 0.0}
+        pq = [(0.0, source)]
+        settled = 0
+        while pq and wanted and settled < cls.WITNESS_SETTLE_LIMIT:
+            dist, node = heapq.heappop(pq)
+            if dist > distances[node]:
+                continue
+            if dist > limit:
+                break
+            settled += 1
+            wanted.discard(node)
+            for n, (w, _) in adj[node].items():
+                if n != skip and dist + w < distances.get(n, INF):
+                    distances[n] = dist + w
+                    heapq.heappush(pq, (dist + w, n))
+        return distances
+
+    def query(self, source: str, target: str):
+        if source not in self.index or target not in self.index:
+            return {'distance': INF, 'path': [target]}
+        s, t = self.index[source], self.index[target]
+        distances = ({s: 0.0}, {t: 0.0})
+        previous = ({s: (-1, -1)}, {t: (-1, -1)})  # node -> (parent, middle of the edge used)
+        pq = ([(0.0, s)], [(0.0, t)])
+        best, meeting = INF, -1
+        while pq[0] or pq[1]:
+            side = 0 if pq[0] and (not pq[1] or pq[0][0][0] <= pq[1][0][0]) else 1
+            dist, node = heapq.heappop(pq[side])
+            if dist > distances[side][node]:
+                continue
+            if dist >= best:
+                pq[side].clear()  # nothing left on this side can improve the meeting point
+                continue
+            other = distances[1 - side].get(node, INF)
+            if dist + other < best:
+                best, meeting = dist + other, node
+            for e in range(self.offsets[node], self.offsets[node + 1]):
+                n, new_dist = self.targets[e], dist + self.weights[e]
+                if new_dist < distances[side].get(n, INF):
+                    distances[side][n] = new_dist
+                    previous[side][n] = (node, self.middles[e])
+                    heapq.heappush(pq[side], (new_dist, n))
+        if meeting == -1:
+            return {'distance': INF, 'path': [target]}
+        edges = []
+        node = meeting
+        while previous[0][node][0] != -1:
+            parent, middle = previous[0][node]
+            edges.append((parent, node, middle))
+            node = parent
+        edges.reverse()
+        node = meeting
+        while previous[1][node][0] != -1:
+            parent, middle = previous[1][node]
+            edges.append((node, parent, middle))
+            node = parent
+        path = [self.ids[s]]
+        for a, b, middle in edges:
+            path.extend(self.ids[x] for x in self._unpack(a, b, middle))
+        return {'distance': best, 'path': path}
+
+    def _unpack(self, a: int, b: int, middle: int) -> List[int]:
+        """Original-road nodes after `a` on the edge a -> b (shortcuts expand recursively)."""
+        out, stack = [], [(a, b, middle)]
+        while stack:
+            a, b, middle = stack.pop()
+            if middle == -1:
+                out.append(b)
+                continue
+            stack.append((middle, b, self._middle(middle, b)))
+            stack.append((a, middle, self._middle(a, middle)))
+        return out
+
+    def _middle(self, a: int, b: int) -> int:
+        low, high = (a, b) if self.rank[a] < self.rank[b] else (b, a)
+        for e in range(self.offsets[low], self.offsets[low + 1]):
+            if self.targets[e] == high:
+                return self.middles[e]
+        raise KeyError(f'No hierarchy edge between {self.ids[a]} and {self.ids[b]}')
+
+    def save(self, path: str):
+        arrays = (self.rank, self.offsets, self.targets, self.weights, self.middles)
+        header = {'ids': self.ids, 'fingerprint': self.fingerprint,
+                  'arrays': [[arr.typecode, len(arr)] for arr in arrays]}
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(json.dumps(header).encode() + b'\n')
+            for arr in arrays:
+                f.write(arr.tobytes())
+
+    @classmethod
+    def load(cls, path: str) -> 'ContractionHierarchy':
+        with open(path, 'rb') as f:
+            if f.readline() != MAGIC:
+                raise ValueError(f'{path} is not a contraction hierarchy artifact')
+            header = json.loads(f.readline())
+            arrays = []
+            for typecode, length in header['arrays']:
+                arr = array(typecode)
+                arr.frombytes(f.read(length * arr.itemsize))
+                arrays.append(arr)
+        return cls(header['ids'], *arrays, fingerprint=header['fingerprint'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build a contraction hierarchy artifact for the carpool road graph.')
+    parser.add_argument('output', help='where to write the artifact')
+    parser.add_argument('--graph', help='graph spec understood by app.loaders, e.g. a SAMPLE_GRAPH-style JSON file '
+                                        'or a .cgraph file (default: app.data.SAMPLE_GRAPH)')
+    parser.add_argument('--standalone', action='store_true',
+                        help="build for the standalone app.py server, whose default SAMPLE_GRAPH differs from app.data's")
+    args = parser.parse_args(argv)
+
+    if args.standalone:
+        from app.engine import build_graph
+    else:
+        from app.data import build_graph
+    graph = build_graph(args.graph)
+    hierarchy = ContractionHierarchy.build(graph)
+    hierarchy.save(args.output)
+    print(f'{len(hierarchy.ids)} nodes, {hierarchy.shortcut_count} shortcuts -> {args.output}')
+
+
+if __name__ == '__main__':
+    main()
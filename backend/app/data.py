@@ -1,4 +1,6 @@
 import random
+from app.graph import Graph
+from app.loaders import load_graph
 
 SAMPLE_GRAPH = {
     'nodes': [
@@ -27,12 +29,22 @@ SAMPLE_GRAPH = {
     ]
 }
 
-def initialize_drivers(count, nodes):
+def build_graph(spec: str = None) -> Graph:
+    """Graph from an app.loaders spec (file, .cgraph or synthetic city), or SAMPLE_GRAPH when none is given."""
+    graph = Graph()
+    if spec:
+        return load_graph(spec, graph)
+    for node in SAMPLE_GRAPH['nodes']:
+        graph.add_node(node['id'], node['lat'], node['lng'], node['name'])
+    for edge in SAMPLE_GRAPH['edges']:
+        graph.add_edge(edge['u'], edge['v'], edge['weight'])
+    return graph
+
+def initialize_drivers(count, node_ids):
     drivers = []
-    available = [n['id'] for n in nodes]
+    node_ids = random.sample(list(node_ids), min(count, len(node_ids)))  # drivers share nodes on tiny graphs
     for i in range(1, count + 1):
-        node_id = random.choice(available)
-        available.remove(node_id)
+        node_id = node_ids[(i - 1) % len(node_ids)]
         drivers.append({
             'id': f'Driver-{i}', 'location': node_id, 'status': 'idle',
             'passengers': [], 'current_route_stops': [], 'final_destination': None
@@ -0,0 +1,1203 @@
+"""Road graph, pooling planner and CarpoolSimulator behind the standalone app.py server."""
+import copy
+import heapq
+import random
+import threading
+import time
+import hashlib
+import json
+import itertools
+import multiprocessing
+import uuid
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as PoolTimeout
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import wraps
+from math import hypot, floor, ceil
+
+try:  # next to app.py (see its imports) or inside the package
+    from contraction import ContractionHierarchy, graph_fingerprint
+    from store import MemoryDriverStore, ReservationConflict
+    from loaders import load_graph
+    from history import RideHistory
+    from metrics import Metrics
+except ImportError:
+    from app.contraction import ContractionHierarchy, graph_fingerprint
+    from app.store import MemoryDriverStore, ReservationConflict
+    from app.loaders import load_graph
+    from app.history import RideHistory
+    from app.metrics import Metrics
+
+try:
+    import numpy as np
+except ImportError:  # the matrix routing backend is optional
+    np = None
+
+metrics = Metrics()  # scraped from /metrics; per-process, so pool workers' searches are not counted
+metrics.describe('carpool_search_expanded_total', 'Nodes settled by graph searches')
+metrics.describe('carpool_search_heap_pushes_total', 'Priority-queue pushes made by graph searches')
+metrics.describe('carpool_plan_candidates_total', 'Partial stop orders (DP states or insertion slots) the planners evaluated')
+metrics.describe('carpool_plan_pruned_total', 'Partial stop orders discarded without being extended, by reason')
+metrics.describe('carpool_pair_candidates_total', 'Waiting riders compared against an incoming rider')
+metrics.describe('carpool_pool_drivers_skipped_total', 'En-route drivers ruled out for pooling by straight-line distance alone')
+metrics.describe('carpool_reservation_conflicts_total', 'Plans abandoned because another request claimed the driver first')
+metrics.describe('carpool_dijkstra_seconds', 'Graph.dijkstra calls that ran a search (path-cache hits are not timed)')
+metrics.describe('carpool_route_seconds', 'Graph.route calls')
+metrics.describe('carpool_submit_phase_seconds', 'Time spent in each phase of CarpoolSimulator.submit')
+
+SAMPLE_GRAPH = {
+    'nodes': [
+        {'id': 'A', 'name': 'A', 'lat': 40.7128, 'lng': -74.0060},
+        {'id': 'B', 'name': 'B', 'lat': 40.7580, 'lng': -73.9855},
+        {'id': 'C', 'name': 'C', 'lat': 40.7829, 'lng': -73.9850},
+        {'id': 'D', 'name': 'D', 'lat': 40.7489, 'lng': -74.0020},
+        {'id': 'E', 'name': 'E', 'lat': 40.7489, 'lng': -73.9680},
+        {'id': 'F', 'name': 'F', 'lat': 40.8000, 'lng': -73.9500},
+        {'id': 'G', 'name': 'G', 'lat': 40.7000, 'lng': -74.0100},
+        {'id': 'H', 'name': 'H', 'lat': 40.7050, 'lng': -74.0200},
+        {'id': 'I', 'name': 'I', 'lat': 40.7711, 'lng': -73.9742},
+        {'id': 'J', 'name': 'J', 'lat': 40.6900, 'lng': -73.9900},
+        {'id': 'K', 'name': 'K', 'lat': 40.7570, 'lng': -73.9550},
+    ],
+    'edges': [
+        {'u': 'A', 'v': 'B', 'weight': 5.2}, {'u': 'A', 'v': 'D', 'weight': 3.1},
+        {'u': 'A', 'v': 'G', 'weight': 2.5}, {'u': 'A', 'v': 'J', 'weight': 1.8},
+        {'u': 'B', 'v': 'C', 'weight': 3.8}, {'u': 'B', 'v': 'E', 'weight': 2.9},
+        {'u': 'B', 'v': 'I', 'weight': 1.5}, {'u': 'C', 'v': 'F', 'weight': 2.2},
+        {'u': 'D', 'v': 'E', 'weight': 4.5}, {'u': 'D', 'v': 'H', 'weight': 2.8},
+        {'u': 'E', 'v': 'C', 'weight': 4.1}, {'u': 'E', 'v': 'K', 'weight': 3.3},
+        {'u': 'F', 'v': 'I', 'weight': 1.9}, {'u': 'G', 'v': 'H', 'weight': 1.9},
+        {'u': 'J', 'v': 'G', 'weight': 1.0}, {'u': 'K', 'v': 'B', 'weight': 2.5}
+    ]
+}
+
+def build_graph(spec=None):
+    # a loaders.load_graph spec (file, .cgraph or synthetic city); this server's SAMPLE_GRAPH by default
+    graph = Graph()
+    if spec: return load_graph(spec, graph)
+    for n in SAMPLE_GRAPH['nodes']:
+        graph.add_node(n['id'], n['lat'], n['lng'], n['name'])
+    for e in SAMPLE_GRAPH['edges']:
+        graph.add_edge(e['u'], e['v'], e['weight'])
+    return graph
+
+class Graph:
+    CACHE_SIZE = 256  # max number of single-source shortest-path trees kept in memory
+    CACHE_MEMORY_BUDGET = 64 * 1024 * 1024  # bytes allowed for cached trees; large graphs keep fewer than CACHE_SIZE
+    MATRIX_MAX_NODES = 4000  # 'auto' only picks the all-pairs matrix up to this many nodes
+    MATRIX_MEMORY_BUDGET = 256 * 1024 * 1024  # bytes allowed for the distance + next-hop matrices
+
+    def __init__(self):
+        self.nodes = {}
+        self.adj = {}  # build-time adjacency lists; released by freeze() in favour of the CSR arrays
+        self._csr = None  # (ids, index, offsets, targets, weights) once frozen
+        self._trees = OrderedDict()  # src -> (dist, prev) arrays by node index, least to most recently used
+        self.cache_hits = self.cache_misses = 0
+        self.backend = 'dijkstra'  # 'dijkstra' (cached trees), 'matrix' (precomputed all-pairs) or 'ch' (contraction hierarchy)
+        self._matrix = None  # (dist, next_hop) once built
+        self._ch = None
+        self.source = self._mapping = None  # .cgraph file this graph is memory-mapped from, if any, and its mmap
+        self._lock = threading.RLock()  # searches share buffers and the LRU cache, so one runs at a time
+
+    def add_node(self, id, lat, lng, name=None):
+        self._thaw()
+        self.nodes[id] = {'id': id, 'lat': lat, 'lng': lng, 'name': name or id}
+        self.adj.setdefault(id, [])
+        self._invalidate()
+
+    def add_edge(self, u, v, w):
+        self._thaw()
+        self.adj.setdefault(u, []).append({'node': v, 'weight': w})
+        self.adj.setdefault(v, []).append({'node': u, 'weight': w})
+        self._invalidate()
+
+    def _invalidate(self):
+        # any mutation can change shortest paths, so cached trees are dropped wholesale
+        self._trees.clear()
+        self._matrix = self._ch = None  # rebuilt lazily on the next matrix / hierarchy query
+
+    def freeze(self):
+        # compile the adjacency lists into CSR arrays: node i's edges are targets/weights[offsets[i]:offsets[i+1]]
+        if self._csr is not None: return self._csr
+        ids = list(self.nodes) + [n for n in self.adj if n not in self.nodes]
+        index = {n: i for i, n in enumerate(ids)}
+        offsets, targets, weights = array('l', [0]), array('l'), array('d')
+        for n in ids:
+            for nb in self.adj.get(n, []):
+                targets.append(index[nb['node']])
+                weights.append(nb['weight'])
+            offsets.append(len(targets))
+        self._csr = (ids, index, offsets, targets, weights)
+        self._compiled()
+        return self._csr
+
+    def load_compiled(self, nodes, ids, index, offsets, targets, weights, lat=None, lng=None, heuristic_scale=None,
+                      source=None, mapping=None):
+        # adopt ready-made CSR arrays (e.g. memory-mapped by loaders.load_binary) without building adjacency lists;
+        # `mapping` is the mmap they are views of, held for as long as the graph uses them, `source` its file
+        self.__init__()
+        self.nodes, self._csr = nodes, (ids, index, offsets, targets, weights)
+        self.source, self._mapping = source, mapping
+        self._compiled(lat, lng, heuristic_scale)
+
+    def _compiled(self, lat=None, lng=None, heuristic_scale=None):
+        self.adj = None
+        ids = self._csr[0]
+        # search buffers reused by every query; only the entries a search touched get reset
+        self._dist, self._prev = array('d', [float('inf')]) * len(ids), array('l', [-1]) * len(ids)
+        self._dist_b, self._prev_b = array('d', self._dist), array('l', self._prev)  # backward half of bidirectional search
+        if heuristic_scale is None: self._calibrate()
+        else: self._lat, self._lng, self.heuristic_scale = lat, lng, heuristic_scale
+
+    def __getstate__(self):
+        # compact form shipped to worker processes: nodes, CSR arrays and routing backend; caches, search
+        # buffers and the lock stay behind, and so does the matrix (n^2 entries, and n full searches to rebuild,
+        # which is why the matrix backend never uses the pool). A memory-mapped graph only sends its path, and
+        # every worker maps the same pages
+        if getattr(self, 'source', None) and self._csr is not None:
+            return {'source': self.source, 'backend': self.backend, 'ch': self._ch}
+        ids, _, offsets, targets, weights = self.freeze()
+        return {'nodes': self.nodes, 'csr': (ids, offsets, targets, weights), 'backend': self.backend, 'ch': self._ch}
+
+    def __setstate__(self, state):
+        if 'source' in state: load_graph(state['source'], self)
+        else:
+            self.__init__()
+            ids, offsets, targets, weights = state['csr']
+            self.nodes = state['nodes']
+            self._csr = (ids, {n: i for i, n in enumerate(ids)}, offsets, targets, weights)
+            self._compiled()
+        self.backend, self._ch = state['backend'], state['ch']
+
+    def _calibrate(self):
+        # A* heuristic = scale * straight-line lat/lng distance; the scale is the smallest weight per unit of
+        # geometric length over all edges, so the heuristic never overestimates (admissible and consistent)
+        ids, _, offsets, targets, weights = self._csr
+        self._lat = array('d', [self.nodes[n]['lat'] if n in self.nodes else 0 for n in ids])
+        self._lng = array('d', [self.nodes[n]['lng'] if n in self.nodes else 0 for n in ids])
+        scale = float('inf')
+        for u in range(len(ids)):
+            for e in range(offsets[u], offsets[u + 1]):
+                g = hypot(self._lat[u] - self._lat[targets[e]], self._lng[u] - self._lng[targets[e]])
+                if g > 0: scale = min(scale, weights[e] / g)
+        # nodes without coordinates would break admissibility, so fall back to plain Dijkstra ordering
+        self.heuristic_scale = 0 if scale == float('inf') or len(ids) > len(self.nodes) else scale
+
+    def _thaw(self):
+        if self._csr is None: return
+        self.nodes, self.source, self._mapping = dict(self.nodes), None, None  # a loaded node table is read-only
+        ids, _, offsets, targets, weights = self._csr
+        self.adj = {n: [{'node': ids[targets[e]], 'weight': weights[e]} for e in range(offsets[i], offsets[i + 1])] for i, n in enumerate(ids)}
+        self._csr = None
+
+    def cache_info(self):
+        return {'hits': self.cache_hits, 'misses': self.cache_misses, 'size': len(self._trees), 'maxsize': self.cache_capacity()}
+
+    def cache_capacity(self):
+        # each tree is a distance and a predecessor array over all nodes, so the budget caps how many fit
+        tree_bytes = (array('d').itemsize + array('l').itemsize) * max(1, len(self.freeze()[0]))
+        return max(1, min(self.CACHE_SIZE, self.CACHE_MEMORY_BUDGET // tree_bytes))
+
+    def _tree(self, src):
+        if src in self._trees:
+            self.cache_hits += 1
+            self._trees.move_to_end(src)
+            return self._trees[src]
+        self.cache_misses += 1
+        self._trees[src] = self._sssp(self.freeze()[1][src])
+        if len(self._trees) > self.cache_capacity():
+            self._trees.popitem(last=False)  # evict the least recently used tree
+        return self._trees[src]
+
+    def _sssp(self, s):
+        _, _, offsets, targets, weights = self.freeze()
+        dist, prev = self._dist, self._prev
+        touched, expanded, pushes = [s], 0, 1
+        dist[s] = 0  # Distance from source to itself is 0
+        pq = [(0, s)] # min-heap to get the node with the current shortest distance
+        while pq:
+            d, u = heapq.heappop(pq)  # smallest tentative distance d from the priority queue.
+            if d > dist[u]: continue  # stale heap entry, a shorter path was already settled
+            expanded += 1
+            for e in range(offsets[u], offsets[u + 1]):  # loop over all neighbours (no early exit: the whole tree gets cached)
+                v, nd = targets[e], d + weights[e]
+                if nd < dist[v]:  # if it is shorter than the best we upadate our best route
+                    if dist[v] == float('inf'): touched.append(v)
+                    dist[v], prev[v] = nd, u
+                    heapq.heappush(pq, (nd, v))  # add it to the min heap
+                    pushes += 1
+        tree = (array('d', dist), array('l', prev))
+        self._count('tree', expanded, pushes)
+        self._reset(touched)
+        return tree
+
+    @staticmethod
+    def _count(search, expanded, pushes):
+        # searches count in locals and report once, so the per-node cost is an integer add
+        metrics.inc('carpool_search_expanded_total', expanded, search=search)
+        metrics.inc('carpool_search_heap_pushes_total', pushes, search=search)
+
+    def _reset(self, touched, dist=None, prev=None):
+        dist, prev = self._dist if dist is None else dist, self._prev if prev is None else prev
+        for i in touched:
+            dist[i], prev[i] = float('inf'), -1
+
+    def _path(self, prev, j):
+        ids, path = self._csr[0], []
+        while j != -1:
+            path.append(ids[j])
+            j = prev[j]
+        return path[::-1]
+
+    def _astar(self, s, t):
+        _, _, offsets, targets, weights = self._csr
+        lat, lng, scale, tl, tg = self._lat, self._lng, self.heuristic_scale, self._lat[t], self._lng[t]
+        dist, prev, touched, expanded, pushes = self._dist, self._prev, [s], 0, 1
+        dist[s] = 0
+        pq = [(scale * hypot(lat[s] - tl, lng[s] - tg), 0, s)]  # ordered by distance so far + heuristic to t
+        while pq:
+            _, d, u = heapq.heappop(pq)
+            if d > dist[u]: continue
+            expanded += 1
+            if u == t: break  # consistent heuristic: t is settled with its exact distance
+            for e in range(offsets[u], offsets[u + 1]):
+                v, nd = targets[e], d + weights[e]
+                if nd < dist[v]:
+                    if dist[v] == float('inf'): touched.append(v)
+                    dist[v], prev[v] = nd, u
+                    heapq.heappush(pq, (nd + scale * hypot(lat[v] - tl, lng[v] - tg), nd, v))
+                    pushes += 1
+        result = {'distance': dist[t], 'path': self._path(prev, t)}
+        self._count('astar', expanded, pushes)
+        self._reset(touched)
+        return result
+
+    def _bidirectional(self, s, t):
+        ids, _, offsets, targets, weights = self._csr
+        dist, prev = (self._dist, self._dist_b), (self._prev, self._prev_b)
+        done, touched, pq = (set(), set()), ([s], [t]), ([(0, s)], [(0, t)])
+        dist[0][s] = dist[1][t] = 0
+        best, meet, pushes = float('inf'), -1, 2
+        if s == t: best, meet = 0, s
+        while pq[0] and pq[1] and pq[0][0][0] + pq[1][0][0] < best:
+            side = 0 if pq[0][0][0] <= pq[1][0][0] else 1  # grow whichever frontier is closer
+            d, u = heapq.heappop(pq[side])
+            if u in done[side]: continue
+            done[side].add(u)
+            for e in range(offsets[u], offsets[u + 1]):
+                v, nd = targets[e], d + weights[e]
+                if nd < dist[side][v]:
+                    if dist[side][v] == float('inf'): touched[side].append(v)
+                    dist[side][v], prev[side][v] = nd, u
+                    heapq.heappush(pq[side], (nd, v))
+                    pushes += 1
+                if nd + dist[1 - side][v] < best:  # both searches reached v: candidate s -> v -> t path
+                    best, meet = nd + dist[1 - side][v], v
+        if meet == -1: result = {'distance': float('inf'), 'path': [ids[t]]}
+        else: result = {'distance': best, 'path': self._path(prev[0], meet) + self._path(prev[1], meet)[::-1][1:]}
+        self._count('bidirectional', len(done[0]) + len(done[1]), pushes)
+        for side in (0, 1): self._reset(touched[side], dist[side], prev[side])
+        return result
+
+    def matrix_bytes(self):
+        n = len(self.nodes)
+        return n * n * (8 + 4)  # float64 distances + int32 next hops
+
+    def select_backend(self, backend='auto', max_nodes=None, memory_budget=None):
+        # 'auto' uses the matrix only when numpy is present and the graph fits the node/memory limits
+        if backend == 'auto':
+            max_nodes = self.MATRIX_MAX_NODES if max_nodes is None else max_nodes
+            memory_budget = self.MATRIX_MEMORY_BUDGET if memory_budget is None else memory_budget
+            fits = len(self.nodes) <= max_nodes and self.matrix_bytes() <= memory_budget
+            backend = 'matrix' if np is not None and fits else 'dijkstra'
+        if backend not in ('dijkstra', 'matrix', 'ch'):
+            raise ValueError(f'Unknown routing backend: {backend}')
+        if backend == 'matrix':
+            if np is None: raise RuntimeError('The matrix routing backend requires numpy')
+            self._build_matrix()
+        if backend == 'ch' and self._ch is None: self._ch = ContractionHierarchy.build(self)
+        self.backend = backend
+        return backend
+
+    def load_hierarchy(self, path):
+        # prebuilt artifact from `python -m app.contraction --standalone`; refuse one built for a different graph
+        ch = ContractionHierarchy.load(path)
+        if ch.fingerprint != graph_fingerprint(self.freeze()):
+            raise ValueError(f'{path} was built for a different graph (use --standalone for this server\'s sample graph)')
+        self._ch, self.backend = ch, 'ch'
+
+    def _build_matrix(self):
+        n = len(self.freeze()[0])
+        dist = np.full((n, n), np.inf)
+        nxt = np.full((n, n), -1, dtype=np.int32)
+        for j in range(n):
+            # the graph is undirected, so the tree rooted at node j gives every node's next hop towards j
+            d, prev = self._sssp(j)
+            dist[:, j], nxt[:, j] = np.frombuffer(d), np.frombuffer(prev, dtype=np.dtype(f'i{prev.itemsize}'))
+        self._matrix = (dist, nxt)
+
+    def dijkstra(self, src, dst, method=None):
+        with self._lock:
+            if method is None and self.backend == 'dijkstra' and src in self._trees:
+                return self._dijkstra(src, dst)  # cache hit: counted by the path-cache metrics; timing it would double its cost
+            with metrics.timer('carpool_dijkstra_seconds', search=method or self.backend):
+                return self._dijkstra(src, dst, method)
+
+    def _dijkstra(self, src, dst, method=None):
+        # method: None uses the configured backend, 'astar' or 'bidirectional' run a point-to-point search
+        ids, index = self.freeze()[:2]
+        if src not in index or dst not in index: return {'distance': float('inf'), 'path': [dst]}
+        i, j = index[src], index[dst]
+        if method == 'astar': return self._astar(i, j)
+        if method == 'bidirectional': return self._bidirectional(i, j)
+        if method is not None: raise ValueError(f'Unknown search method: {method}')
+        if self.backend == 'matrix':
+            if self._matrix is None: self._build_matrix()
+            dist, nxt = self._matrix
+            d = float(dist[i, j])
+            if d == float('inf'): return {'distance': d, 'path': [dst]}
+            path = [src]
+            while i != j:
+                i = int(nxt[i, j])  # follow the next-hop table towards dst
+                path.append(ids[i])
+            return {'distance': d, 'path': path}
+        if self.backend == 'ch':
+            if self._ch is None: self._ch = ContractionHierarchy.build(self)
+            return self._ch.query(src, dst)
+        dist, prev = self._tree(src)
+        return {'distance': dist[j], 'path': self._path(prev, j)}  # path reconstruction from prev
+
+    def nearest(self, src, targets, k=1):
+        with self._lock: return self._nearest(src, targets, k)
+
+    def _nearest(self, src, targets, k=1):
+        # k closest of `targets` to src as [(node, distance)]; one search that stops once k targets are settled.
+        # `targets` is only tested for membership while searching, so a dict or set kept by the caller costs nothing
+        ids, index, offsets, tgt, weights = self.freeze()
+        if src not in index: return []
+        if self.backend in ('matrix', 'ch') or src in self._trees:
+            found = [(t, self.dijkstra(src, t)['distance']) for t in list(targets) if t in index]
+            return sorted([f for f in found if f[1] < float('inf')], key=lambda f: f[1])[:k]
+        dist, s = self._dist, index[src]
+        done, found, touched, pq, pushes = set(), [], [s], [(0, s)], 1
+        dist[s] = 0
+        while pq and len(found) < k:
+            d, u = heapq.heappop(pq)
+            if u in done: continue
+            done.add(u)
+            if ids[u] in targets: found.append((ids[u], d))
+            for e in range(offsets[u], offsets[u + 1]):
+                v, nd = tgt[e], d + weights[e]
+                if nd < dist[v]:
+                    if dist[v] == float('inf'): touched.append(v)
+                    dist[v] = nd
+                    heapq.heappush(pq, (nd, v))
+                    pushes += 1
+        self._count('nearest', len(done), pushes)
+        self._reset(touched)
+        return found
+
+    def lower_bound(self, a, b):
+        # straight-line distance in edge-weight units, never more than the shortest a -> b path (see _calibrate)
+        index = self.freeze()[1]
+        if a not in index or b not in index: return 0
+        i, j = index[a], index[b]
+        return self.heuristic_scale * hypot(self._lat[i] - self._lat[j], self._lng[i] - self._lng[j])
+
+    def route(self, stops, method=None):
+        with metrics.timer('carpool_route_seconds'): return self._route(stops, method)
+
+    def _route(self, stops, method=None):
+        total, path = 0, []
+        if len(stops) < 2: return {'distance': 0, 'path': []}
+        for i in range(len(stops) - 1):
+            seg = self.dijkstra(stops[i], stops[i + 1], method)
+            if seg['distance'] == float('inf'): return {'distance': float('inf'), 'path': []}
+            total += seg['distance']
+            path += seg['path'] if i == 0 else seg['path'][1:]
+        return {'distance': total, 'path': path}
+
+def min_cost_assignment(cost):
+    # Hungarian algorithm with potentials, O(n^2 m) for an n x m matrix; returns (row, col) pairs and leaves
+    # rows unmatched when there are more rows than columns or only infinite costs are left
+    if not cost or not cost[0]: return []
+    rows, cols = len(cost), len(cost[0])
+    if rows > cols:
+        return [(r, c) for c, r in min_cost_assignment([list(col) for col in zip(*cost)])]
+    finite = [x for row in cost for x in row if x != float('inf')]
+    big = (sum(finite) + 1) * 2 if finite else 1  # stands in for infinity so the potentials stay finite
+    a = [[x if x != float('inf') else big for x in row] for row in cost]
+    u, v, p, way = [0] * (rows + 1), [0] * (cols + 1), [0] * (cols + 1), [0] * (cols + 1)
+    for i in range(1, rows + 1):
+        p[0], j0 = i, 0
+        minv, used = [float('inf')] * (cols + 1), [False] * (cols + 1)
+        while p[j0]:
+            used[j0], i0, delta, j1 = True, p[j0], float('inf'), 0
+            for j in range(1, cols + 1):
+                if used[j]: continue
+                cur = a[i0 - 1][j - 1] - u[i0] - v[j]
+                if cur < minv[j]: minv[j], way[j] = cur, j0
+                if minv[j] < delta: delta, j1 = minv[j], j
+            for j in range(cols + 1):
+                if used[j]: u[p[j]] += delta; v[j] -= delta
+                else: minv[j] -= delta
+            j0 = j1
+        while j0:  # augment along the alternating path
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    return sorted((p[j] - 1, j - 1) for j in range(1, cols + 1) if p[j] and cost[p[j] - 1][j - 1] != float('inf'))
+
+class GridIndex:
+    # uniform lat/lng grid; near() returns every item in the square of cells covering the radius
+    def __init__(self, cell):
+        self.cell = cell
+        self.cells = {}  # (row, col) -> {key: insertion order}
+        self.items = {}  # key -> (cell, insertion order, value)
+        self._order = itertools.count()
+        self._lock = threading.RLock()
+
+    def __len__(self): return len(self.items)
+
+    def values(self):
+        with self._lock: return [v for _, _, v in sorted(self.items.values(), key=lambda x: x[1])]
+
+    def _cell(self, lat, lng): return (floor(lat / self.cell), floor(lng / self.cell))
+
+    def add(self, key, lat, lng, value):
+        with self._lock:
+            self.remove(key)  # re-adding a key moves it
+            c, order = self._cell(lat, lng), next(self._order)
+            self.items[key] = (c, order, value)
+            self.cells.setdefault(c, {})[key] = order
+
+    def remove(self, key):
+        with self._lock:
+            if key not in self.items: return
+            c = self.items.pop(key)[0]
+            del self.cells[c][key]
+            if not self.cells[c]: del self.cells[c]
+
+    def near(self, lat, lng, radius):
+        with self._lock: return self._near(lat, lng, radius)
+
+    def _near(self, lat, lng, radius):
+        (row, col), k = self._cell(lat, lng), ceil(radius / self.cell)
+        if (2 * k + 1) ** 2 > len(self.cells):  # fewer occupied cells than cells to probe: scan occupied ones
+            hits = [(key, o) for (r, c), cell in self.cells.items() if abs(r - row) <= k and abs(c - col) <= k for key, o in cell.items()]
+        else:
+            hits = [(key, o) for r in range(row - k, row + k + 1) for c in range(col - k, col + k + 1) for key, o in self.cells.get((r, c), {}).items()]
+        return [self.items[key][2] for key, _ in sorted(hits, key=lambda h: h[1])]  # oldest first
+
+class NodeIndex:
+    # items by the graph node they are at, oldest first within a node; kept up to date on every add/remove, so
+    # `at` can be handed to Graph.nearest as its targets as it is
+    def __init__(self):
+        self.at = {}  # node -> {key: value}
+        self.nodes = {}  # key -> node
+        self._lock = threading.RLock()
+
+    def __len__(self): return len(self.nodes)
+
+    def values(self):
+        with self._lock: return [v for items in self.at.values() for v in items.values()]
+
+    def first(self, node):
+        with self._lock: return next(iter(self.at[node].values()), None) if node in self.at else None
+
+    def add(self, key, node, value):
+        with self._lock:
+            self.remove(key)  # re-adding a key moves it to the back
+            self.nodes[key] = node
+            self.at.setdefault(node, {})[key] = value
+
+    def remove(self, key):
+        with self._lock:
+            node = self.nodes.pop(key, None)
+            if node is None: return
+            del self.at[node][key]
+            if not self.at[node]: del self.at[node]
+
+def publishes(method):
+    # state-changing simulator calls push everything they changed to the listeners as one delta
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        since = self.version
+        res = method(self, *args, **kwargs)
+        if self.listeners and self.version > since:
+            delta = self.status(since)
+            for fn in self.listeners: fn(delta)
+        return res
+    return wrapper
+
+_pool_worker = None  # per-process evaluator set up by _init_pool_worker
+
+def _init_pool_worker(graph, config):
+    # runs once in each worker process: the graph arrives in its compact pickled form and serves every task
+    global _pool_worker
+    _pool_worker = CarpoolSimulator.__new__(CarpoolSimulator)
+    _pool_worker.graph = graph
+    _pool_worker.__dict__.update(config)
+
+def _evaluate_pool_chunk(drivers, req):
+    return _pool_worker._evaluate_drivers(drivers, req)
+
+class CarpoolSimulator:
+    MAX_DETOUR = 0.3
+    CAPACITY = 3
+    PLANNER = 'auto'  # 'exact' (bitmask DP), 'insertion' (cheapest insertion) or 'auto'
+    EXACT_PLAN_MAX_RIDERS = 5  # 'auto' switches to insertion above this many riders per vehicle
+    PROX_THRESHOLD = 0.015  # roughly ~1.5km equivalent
+
+    ROUTING_BACKEND = 'dijkstra'  # 'dijkstra', 'matrix', 'ch' or 'auto' (matrix when the graph fits in memory)
+
+    MAX_ATTEMPTS = 5  # re-plans after losing a driver reservation before giving up
+
+    FLEET_SIZE = 3
+
+    REMOVALS_KEPT = 1000  # waiting-list removals remembered for /status deltas
+
+    POOL_WORKERS = 0  # processes evaluating pooling candidates in parallel; 0 or 1 keeps it serial
+    PARALLEL_MIN_DRIVERS = 16  # below this many candidate drivers the serial path beats the IPC overhead
+    POOL_TIMEOUT = 30.0  # seconds to wait on the workers (including their start-up) before evaluating serially
+
+    def __init__(self, backend=None, hierarchy=None, store=None, workers=None, fleet=None, graph=None, history=None):
+        self.graph = build_graph(graph)
+        self.graph.freeze()
+        if hierarchy: self.graph.load_hierarchy(hierarchy)
+        else: self.graph.select_backend(backend or self.ROUTING_BACKEND)
+        self.drivers = self._init_drivers(fleet or self.FLEET_SIZE)
+        self.requests = []
+        self.history = RideHistory(history)  # recent entries in memory; with a path, every entry on disk too
+        # versioned state for /status?since=: every change bumps self.version and records when it happened
+        self.version = 1
+        self._driver_versions = {d['id']: 1 for d in self.drivers}
+        # waiting-list removals are only remembered for the last REMOVALS_KEPT; deltas from before the oldest
+        # one kept (removals_floor) would miss some, so those clients get a reset delta instead
+        self._request_versions, self._removed_requests, self._removals_floor = {}, deque(), 0
+        self._trips = {}  # waiting request id -> its direct trip, see _trip()
+        self.listeners = []  # called with the delta produced by each submit/complete
+        self._graph_data = self._graph_etag = None
+        # idle drivers by node (searched by road distance), waiting requests by source (cell = proximity threshold)
+        self.idle_index, self.request_index = NodeIndex(), GridIndex(self.PROX_THRESHOLD)
+        for d in self.drivers: self._index_driver(d)
+        # drivers live in a store (in-memory, or SQLite shared by every worker); the local copies are refreshed
+        # from it before each operation and only changed through an atomic per-driver reservation
+        self._lock = threading.RLock()  # guards requests, history and version bookkeeping
+        self.store = store or MemoryDriverStore()
+        self.store.seed(self.drivers)
+        self._by_id, self._store_versions = {d['id']: d for d in self.drivers}, {}
+        self._sync()
+        self.pool_workers = self.POOL_WORKERS if workers is None else workers
+        self._executor = None  # started on the first parallel evaluation
+
+    def _init_drivers(self, n):
+        nodes = list(self.graph.nodes)
+        nodes = random.sample(nodes, min(n, len(nodes)))
+        return [{
+            'id': f'Driver-{i+1}',
+            'location': nodes[i % len(nodes)],
+            'status': 'idle',
+            'passengers': [],
+            'stops': [],
+            'pooled': False  # whether the current ride has carried more than one rider
+        } for i in range(n)]
+
+    def graph_data(self):
+        # built on first use and kept: for a large loaded graph this is the only place every road becomes a dict
+        if self._graph_data is None:
+            ids, _, offsets, targets, weights = self.graph.freeze()
+            edges = [{'u': ids[i], 'v': ids[targets[e]], 'weight': weights[e]}
+                     for i in range(len(ids)) for e in range(offsets[i], offsets[i + 1]) if i < targets[e]]
+            self._graph_data = {'nodes': list(self.graph.nodes.values()), 'edges': edges}
+            self._graph_etag = hashlib.sha1(json.dumps(self._graph_data, sort_keys=True).encode()).hexdigest()
+        return self._graph_data
+
+    @property
+    def graph_etag(self):
+        self.graph_data()
+        return self._graph_etag
+
+    def status(self, since=None):
+        with self._lock: return self._status(since)
+
+    def _status(self, since):
+        # copies, so serialization outside the lock never sees a half-applied change
+        drivers = [{**d, 'passengers': list(d['passengers']), 'stops': list(d['stops'])} for d in self.drivers]
+        if since is None:
+            return {
+                **self.graph_data(),
+                'drivers': drivers,
+                'requests': list(self.requests),
+                'rideHistory': self.history.recent(),
+                'matches': [],
+                'version': self.version
+            }
+        if since < self._removals_floor:
+            # too far behind to list what was removed: the same shape, but replacing the client's state
+            return {'version': self.version, 'since': since, 'reset': True, 'drivers': drivers,
+                    'requests': {'added': list(self.requests), 'removed': []}, 'rideHistory': self.history.recent()}
+        removed = []
+        for v, rid in reversed(self._removed_requests):  # newest first, so only the part newer than `since` is read
+            if v <= since: break
+            removed.append(rid)
+        # delta since a version the client already has; the static graph comes from /graph instead
+        return {
+            'version': self.version,
+            'since': since,
+            'drivers': [d for d in drivers if self._driver_versions[d['id']] > since],
+            'requests': {
+                'added': [r for r in self.requests if self._request_versions[r['id']] > since],
+                'removed': removed[::-1]
+            },
+            'rideHistory': self.history.since(since)
+        }
+
+    def _bump(self):
+        with self._lock:
+            self.version += 1
+            return self.version
+
+    def _touch(self, d):
+        with self._lock: self._driver_versions[d['id']] = self._bump()
+
+    def _log(self, entry):
+        with self._lock: self.history.append(entry, self._bump())
+
+    def _sync(self):
+        # pull drivers that other threads or workers changed; returns the versions the caller's plan is based on
+        with self._lock:
+            for state, version in self.store.changed_since(self._store_versions):
+                d = self._by_id.get(state['id'])
+                if d is None: continue
+                d.clear()
+                d.update(state)
+                self._store_versions[d['id']] = version
+                self._index_driver(d)
+                self._touch(d)
+            return dict(self._store_versions)
+
+    @contextmanager
+    def _claim(self, d, seen):
+        # exclusive use of a driver, only if nobody changed it since `seen`; the body's changes are committed on exit.
+        # The body yields back what must wait for the commit (history) and how to undo its other effects
+        # (waiting-list removals); if the body or the commit fails, those are undone and the driver put back
+        token = self.store.reserve(d['id'], seen[d['id']])
+        if token is None: raise ReservationConflict(f"{d['id']} changed while planning")
+        before, done, undo = copy.deepcopy(d), [], []
+        try:
+            yield done, undo
+            version = self.store.commit(token, d)
+        except BaseException:
+            self.store.release(token)  # nothing to release if the commit already lost the lease
+            for fn in reversed(undo): fn()
+            self._restore(d, before)
+            raise
+        with self._lock: self._store_versions[d['id']] = seen[d['id']] = version
+        for fn in done: fn()
+
+    def _restore(self, d, state):
+        # forgetting the store version makes the next _sync reload the driver, whatever the store ended up with
+        with self._lock:
+            d.clear()
+            d.update(state)
+            self._store_versions.pop(d['id'], None)
+            self._index_driver(d)
+            self._touch(d)
+
+    def _geo(self, id): 
+        n = self.graph.nodes[id]; 
+        return (n['lat'], n['lng'])
+
+    def _distance(self, a, b):
+        la, loa = self._geo(a); lb, lob = self._geo(b)
+        return hypot(la - lb, loa - lob)
+
+    def _close(self, a, b):
+        return self._distance(a, b) <= self.PROX_THRESHOLD
+
+    def _index_driver(self, d):
+        # only idle drivers are indexed; call after every status or location change
+        if d['status'] == 'idle': self.idle_index.add(d['id'], d['location'], d)
+        else: self.idle_index.remove(d['id'])
+
+    def _enqueue(self, req, trip=None):
+        trip = trip or self._trip(req)  # routed once here, not again for every rider it is compared with
+        with self._lock:
+            self.requests.append(req)
+            self.request_index.add(req['id'], *self._geo(req['source']), req)
+            self._trips[req['id']] = trip
+            self._request_versions[req['id']] = self._bump()
+
+    def _dequeue(self, req):
+        # False if another thread already took this request off the waiting list
+        with self._lock:
+            if req['id'] not in self._request_versions: return False
+            self.requests.remove(req)
+            self.request_index.remove(req['id'])
+            self._trips.pop(req['id'], None)
+            del self._request_versions[req['id']]
+            self._removed_requests.append((self._bump(), req['id']))
+            if len(self._removed_requests) > self.REMOVALS_KEPT:
+                self._removals_floor = self._removed_requests.popleft()[0]
+            return True
+    
+    def _find_best_pool(self, req):
+        # we loop through all the drivers who are currently en-route and have capacity left
+        drivers = [x for x in self.drivers if x['status'] == 'en-route' and len(x['passengers']) < self.CAPACITY]
+        # with the matrix backend every leg is a table lookup, and each worker would first rebuild the table
+        if self.pool_workers > 1 and len(drivers) >= self.PARALLEL_MIN_DRIVERS and self.graph.backend != 'matrix':
+            options = self._evaluate_parallel(drivers, req)
+        else:
+            options = self._evaluate_drivers(drivers, req)
+        best = None
+        for d, option in zip(drivers, options):  # ties keep the earliest driver, like the serial loop
+            if option and (not best or option['distance'] < best['distance']):
+                best = {'driver': d, **option}
+        if best: best['route'] = self.graph.route(best['stops'])  # only the winner's path is built
+        return best
+
+    def _evaluate_drivers(self, drivers, req):
+        # each driver only has to beat the best plan found so far, which lets its plan search stop early;
+        # a driver cut off that way could not have won, so the reduction in _find_best_pool is unchanged
+        options, best = [], float('inf')
+        for d in drivers:
+            option = self._evaluate_pool(d, req, best)
+            if option: best = min(best, option['distance'])
+            options.append(option)
+        return options
+
+    def _evaluate_pool(self, d, req, best=float('inf')):
+        # we store the current stops, distance and passengers
+        base_stops = [d['location']] + [p['source'] for p in d['passengers'] if not p.get('onboard')] + [p['destination'] for p in d['passengers']]
+        base_distance = self.graph.route(base_stops)['distance']
+        # a longer plan is no use; the slack keeps float rounding in the bounds from cutting a plan right at the
+        # limit, which the exact checks below still accept or reject as before
+        limit = min(base_distance + self.MAX_DETOUR * max(base_distance, 0.1), best) * (1 + 1e-9)
+
+        # in any stop order the car drives to the pickup and on from there to the drop, each at least the
+        # straight-line distance: drivers that cannot make the limit even so are skipped without planning
+        reach = self.graph.lower_bound(d['location'], req['source']) + self.graph.lower_bound(req['source'], req['destination'])
+        if reach > limit:
+            metrics.inc('carpool_pool_drivers_skipped_total')
+            return None
+
+        # cheapest valid pickup/drop order for the driver once the new rider is added
+        plan = self._plan_stops(d, req, limit)
+        if plan is None: return None
+
+        stops, distance = plan
+        if distance == float('inf'): return None
+        detour_ratio = (distance - base_distance) / max(base_distance, 0.1)
+        if detour_ratio > self.MAX_DETOUR: return None  # we are checking if the detour is within 30%
+        return {'stops': [d['location']] + stops, 'distance': distance, 'detour': detour_ratio, 'added': distance - base_distance}
+
+    def _evaluate_parallel(self, drivers, req):
+        # contiguous chunks (a few per worker) so results come back in driver order
+        size = -(-len(drivers) // (self.pool_workers * 4))
+        try:
+            if self._executor is None:
+                config = {k: getattr(self, k) for k in ('MAX_DETOUR', 'PLANNER', 'EXACT_PLAN_MAX_RIDERS')}
+                # spawned, not forked: a forked worker inherits whatever locks other threads held at that moment
+                self._executor = ProcessPoolExecutor(self.pool_workers, mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=_init_pool_worker, initargs=(self.graph, config))
+            futures = [self._executor.submit(_evaluate_pool_chunk, drivers[i:i + size], req) for i in range(0, len(drivers), size)]
+            deadline = time.monotonic() + self.POOL_TIMEOUT
+            return [option for f in futures for option in f.result(max(0.0, deadline - time.monotonic()))]
+        except (BrokenProcessPool, PoolTimeout):  # a worker died or hung; drop the pool (a fresh one starts next time) and finish serially
+            if self._executor is not None: self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            return self._evaluate_drivers(drivers, req)
+
+    def close(self):
+        if self._executor is not None: self._executor.shutdown()
+        self._executor = None
+
+    def _plan_stops(self, d, req, limit=float('inf')):
+        # (stops after the driver's location, their distance), or None when no order stays within `limit`
+        passengers = d['passengers'] + [req]
+        if self.PLANNER == 'exact' or (self.PLANNER == 'auto' and len(passengers) <= self.EXACT_PLAN_MAX_RIDERS):
+            return self._plan_exact(d['location'], passengers, limit)
+        return self._plan_insertion(d, req, limit)
+
+    def _plan_exact(self, start, passengers, limit=float('inf')):
+        # bitmask DP over (visited points, last point); bit 2k is passenger k's pickup, bit 2k+1 its drop.
+        # Only precedence-valid masks are ever reached, so the state space is 3^n instead of (2n)!
+        pts = [start] + [x for p in passengers for x in (p['source'], p['destination'])]  # point index = bit + 1
+        leg = [[self.graph.dijkstra(a, b)['distance'] for b in pts] for a in pts]
+        start_mask = sum(1 << 2 * k for k, p in enumerate(passengers) if p.get('onboard'))  # already picked up
+
+        def rest(state):  # lower bound on finishing from `state`: every point left is at least its leg away
+            mask, last = state
+            return max((leg[last][b + 1] for b in range(len(pts) - 1) if not mask >> b & 1), default=0)
+
+        best = {(start_mask, 0): (0, None)}  # state -> (cost, previous state)
+        layer, tried, dominated, bounded = [(start_mask, 0)], 0, 0, 0
+        for _ in range(len(pts) - 1 - bin(start_mask).count('1')):
+            nxt, before = {}, tried
+            for state in layer:
+                mask, last = state
+                cost = best[state][0]
+                for b in range(len(pts) - 1):
+                    if mask >> b & 1: continue
+                    if b & 1 and not mask >> (b - 1) & 1: continue  # cannot drop before picking up
+                    key, c = (mask | 1 << b, b + 1), cost + leg[last][b + 1]
+                    tried += 1
+                    if c < best.get(key, (float('inf'),))[0]:
+                        best[key] = (c, state)
+                        nxt[key] = True
+            # branch and bound: orders that cannot finish within the limit are not extended
+            layer = [k for k in nxt if best[k][0] + rest(k) <= limit]
+            dominated += tried - before - len(nxt)  # beaten by a cheaper order of the same stops
+            bounded += len(nxt) - len(layer)
+        metrics.inc('carpool_plan_candidates_total', tried, planner='exact')
+        metrics.inc('carpool_plan_pruned_total', dominated, planner='exact', reason='dominated')
+        metrics.inc('carpool_plan_pruned_total', bounded, planner='exact', reason='bound')
+        if not layer: return None
+        state, seq = min(layer, key=lambda k: best[k][0]), []
+        cost = best[state][0]
+        while state != (start_mask, 0):
+            seq.append(pts[state[1]])
+            state = best[state][1]
+        return seq[::-1], cost
+
+    def _plan_insertion(self, d, req, limit=float('inf')):
+        # keep the driver's current stop order and try every (pickup, drop) insertion slot for the new rider
+        stops = d['stops'][1:] if d['stops'][:1] == [d['location']] else list(d['stops'])
+        if not stops: stops = self._remaining_stops(d)
+        seq, src, dst = [d['location']] + stops, req['source'], req['destination']
+        leg = lambda a, b: self.graph.dijkstra(a, b)['distance']
+
+        def delta(i, *inserted):  # extra cost of placing `inserted` between seq[i-1] and seq[i]
+            chain = [seq[i - 1], *inserted] + seq[i:i + 1]
+            cut = leg(seq[i - 1], seq[i]) if i < len(seq) else 0
+            return sum(leg(a, b) for a, b in zip(chain, chain[1:])) - cut
+
+        length = sum(leg(a, b) for a, b in zip(seq, seq[1:]))
+        best, best_cost, room, tried, bounded = None, float('inf'), limit - length, 0, 0
+        for i in range(1, len(seq) + 1):
+            pickup = delta(i, src)
+            if pickup >= best_cost or pickup > room:  # the drop only adds to it (triangle inequality)
+                bounded += len(seq) + 1 - i
+                continue
+            for j in range(i, len(seq) + 1):
+                tried += 1
+                cost = delta(i, src, dst) if i == j else pickup + delta(j, dst)
+                if cost < best_cost:
+                    best, best_cost = (i, j), cost
+        metrics.inc('carpool_plan_candidates_total', tried, planner='insertion')
+        metrics.inc('carpool_plan_pruned_total', bounded, planner='insertion', reason='bound')
+        if best is None or length + best_cost > limit: return None
+        i, j = best
+        return seq[1:i] + [src] + seq[i:j] + [dst] + seq[j:], length + best_cost
+
+    def _remaining_stops(self, d):
+        return [p['source'] for p in d['passengers'] if not p.get('onboard')] + [p['destination'] for p in d['passengers']]
+
+    def _find_idle_driver(self, req):
+        # the graph is undirected, so one search outward from the pickup reaches the nearest idle driver first
+        hit = self.graph.nearest(req['source'], self.idle_index.at)
+        best = hit and self.idle_index.first(hit[0][0])
+        if not best: return None
+        route = self.graph.route([best['location'], req['source'], req['destination']])
+        if route['distance'] == float('inf'): return None
+        return {'driver': best, 'route': route}
+
+    def _trip(self, req):
+        # a rider's direct route plus its path nodes as a bitset over node indices; the bits start at the
+        # lowest index on the path so the integer only spans the part of the graph the route touches
+        route = self.graph.route([req['source'], req['destination']])
+        index = self.graph.freeze()[1]
+        nodes = {index[n] for n in route['path'] if n in index}
+        lo, hi = min(nodes, default=0), max(nodes, default=0)
+        bitmap = bytearray((hi - lo) // 8 + 1)
+        for i in nodes: bitmap[(i - lo) >> 3] |= 1 << ((i - lo) & 7)
+        return {'route': route, 'lo': lo, 'bits': int.from_bytes(bitmap, 'little'), 'size': len(nodes)}
+
+    def _pair(self, req, other, trip=None, other_trip=None):
+        # overlap = number of shared nodes / length of shorter route
+        def route_overlap(t1, t2):
+            a, b = (t1, t2) if t1['lo'] <= t2['lo'] else (t2, t1)
+            shared = bin((a['bits'] >> (b['lo'] - a['lo'])) & b['bits']).count('1')
+            return shared / max(1, min(t1['size'], t2['size']))
+
+        same_origin = self._close(req['source'], other['source'])
+        if not same_origin:
+            return None
+
+        t1 = trip or self._trip(req)
+        t2 = other_trip or self._trips.get(other['id']) or self._trip(other)
+        r1, r2 = t1['route'], t2['route']
+        if r1['distance'] == float('inf') or r2['distance'] == float('inf'):
+            return None
+
+        overlap = route_overlap(t1, t2)
+        if overlap >= 0.4:  # 40% overlap threshold
+            # approximate detour cost by merging both destinations
+            stops = [req['source'], other['destination'], req['destination']]
+            combo_route = self.graph.route(stops)
+            detour = combo_route['distance'] - min(r1['distance'], r2['distance'])
+            if detour / max(r1['distance'], r2['distance']) <= self.MAX_DETOUR:
+                return {'route': combo_route, 'stops': stops, 'overlap': overlap}
+        return None
+
+    def _match_waiting_requests(self, req, seen, trip):
+        # only waiting requests whose sources fall in the neighbouring grid cells can be close enough
+        for other in self.request_index.near(*self._geo(req['source']), self.PROX_THRESHOLD):
+            metrics.inc('carpool_pair_candidates_total')
+            pair = self._pair(req, other, trip)
+            if not pair:
+                continue
+            idle = next((d for d in self.drivers if d['status'] == 'idle'), None)
+            if not idle: return None
+            with self._claim(idle, seen) as (done, undo):
+                if not self._dequeue(other): raise ReservationConflict(f"{other['id']} was matched elsewhere")
+                undo.append(lambda: self._enqueue(other))
+                self._assign(idle, [req, other], pair['stops'], pair['route']['distance'], done)
+            return {
+                'success': True,
+                'message': f"{req['userId']} pooled with {other['userId']} (shared route {pair['overlap']*100:.1f}%)",
+                'assigned_route': pair['route']
+            }
+        return None
+
+    def _new_request(self, uid, src, dst):
+        return {'id': f'R-{uuid.uuid4().hex[:12]}', 'userId': uid, 'source': src, 'destination': dst}
+
+    def _assign(self, d, riders, stops, distance, done):
+        d.update({'status': 'en-route', 'passengers': riders, 'stops': stops, 'pooled': len(riders) > 1})
+        self._index_driver(d)
+        self._touch(d)
+        entry = {'type': 'Pooled' if len(riders) > 1 else 'Assigned', 'driver': d['id'], 'riders': [r['userId'] for r in riders], 'distance': distance}
+        done.append(lambda: self._log(entry))
+
+    def _apply_pool(self, req, pool, done):
+        d = pool['driver']
+        d['passengers'].append(req)
+        d['stops'] = pool['stops']
+        d['status'] = 'en-route'
+        # joining a ride under way: the history counts only the extra planned distance, and the ride as pooled once
+        entry = {'type': 'Pooled', 'driver': d['id'], 'riders': [p['userId'] for p in d['passengers']], 'distance': pool['route']['distance'],
+                 'added': pool['added'], 'newlyPooled': not d.get('pooled')}
+        d['pooled'] = True
+        self._touch(d)
+        done.append(lambda: self._log(entry))
+        return {'success': True, 'message': f"Pooled with {d['id']} (detour {pool['detour']*100:.1f}%)", 'assigned_route': pool['route']}
+
+    def _invalid(self, uid, src, dst):
+        # why a request cannot be served at all, or None; an unknown or unreachable node would otherwise get
+        # a driver assigned with an infinite route
+        if not uid or not src or not dst: return 'Missing data'
+        for node in (src, dst):
+            if node not in self.graph.nodes: return f'Unknown location: {node}'
+        if self.graph.dijkstra(src, dst)['distance'] == float('inf'): return f'No route from {src} to {dst}'
+        return None
+
+    @publishes
+    def submit(self, uid, src, dst):
+        error = self._invalid(uid, src, dst)
+        if error:
+            return {'success': False, 'message': error}
+        return self._submit(self._new_request(uid, src, dst))
+
+    def _submit(self, req):
+        # a conflict means another request claimed a driver this plan relied on: refresh and plan again
+        for _ in range(self.MAX_ATTEMPTS):
+            try: return self._submit_once(req)
+            except ReservationConflict: metrics.inc('carpool_reservation_conflicts_total', op='submit')
+        self._enqueue(req)
+        return {'success': False, 'message': 'No drivers available; added to waiting list.'}
+
+    def _submit_once(self, req):
+        phase = lambda name: metrics.timer('carpool_submit_phase_seconds', phase=name)
+        with phase('sync'): seen = self._sync()
+
+        # Try to pool with existing drivers
+        with phase('pool'):
+            pool = self._find_best_pool(req)
+            if pool:
+                with self._claim(pool['driver'], seen) as (done, _): return self._apply_pool(req, pool, done)
+
+        # Try pooling with waiting riders
+        with phase('pair'):
+            trip = self._trip(req)
+            pair = self._match_waiting_requests(req, seen, trip)
+            if pair:
+                return pair
+
+        # Otherwise assign idle driver
+        with phase('idle'):
+            idle = self._find_idle_driver(req)
+            if idle:
+                d = idle['driver']
+                with self._claim(d, seen) as (done, _): self._assign(d, [req], [req['source'], req['destination']], idle['route']['distance'], done)
+                return {'success': True, 'message': f"Assigned {d['id']} to {req['userId']}", 'assigned_route': idle['route']}
+
+        with phase('enqueue'): self._enqueue(req, trip)
+        return {'success': False, 'message': 'No drivers available; added to waiting list.'}
+
+    @publishes
+    def submit_batch(self, batch):
+        # joint version of submit() for a burst of riders: pool into en-route cars first, then pair with riders
+        # already waiting and within the batch, then solve one min-cost assignment of the remaining groups to
+        # idle drivers by pickup distance
+        results, pending, seen = [None] * len(batch), [], self._sync()
+        for i, item in enumerate(batch):
+            if not isinstance(item, dict):
+                results[i] = {'success': False, 'message': 'Each request must be an object'}
+                continue
+            uid, src, dst = item.get('userId'), item.get('source'), item.get('destination')
+            error = self._invalid(uid, src, dst)
+            if error:
+                results[i] = {'success': False, 'message': error}
+                continue
+            req = self._new_request(uid, src, dst)
+            pool = self._find_best_pool(req)
+            if not pool:
+                pending.append((i, req))
+                continue
+            try:
+                with self._claim(pool['driver'], seen) as (done, _): results[i] = self._apply_pool(req, pool, done)
+            except ReservationConflict:
+                results[i] = self._submit(req)  # lost the car to a concurrent request; fall back to one-by-one
+
+        # riders already on the waiting list come first, as in submit()
+        trips, unmatched = {req['id']: self._trip(req) for _, req in pending}, []
+        for i, req in pending:
+            try: results[i] = self._match_waiting_requests(req, seen, trips[req['id']])
+            except ReservationConflict: results[i] = self._submit(req)
+            if results[i] is None: unmatched.append((i, req))
+        pending = unmatched
+
+        # pooling groups: greedily pair each rider with the first later rider that passes the waiting-list rules
+        groups, used = [], set()
+        for a, (i, req) in enumerate(pending):
+            if a in used: continue
+            used.add(a)
+            group = {'members': [(i, req)], 'stops': [req['source'], req['destination']], 'pair': None}
+            for b in range(a + 1, len(pending)):
+                pair = None if b in used else self._pair(req, pending[b][1], trips[req['id']], trips[pending[b][1]['id']])
+                if pair:
+                    used.add(b)
+                    group.update({'members': [(i, req), pending[b]], 'stops': pair['stops'], 'pair': pair})
+                    break
+            groups.append(group)
+
+        # rider-driver cost matrix: one multi-target search per group covers every idle driver
+        idle, locations = self.idle_index.values(), self.idle_index.at
+        cost = []
+        for g in groups:
+            dists = dict(self.graph.nearest(g['stops'][0], locations, k=len(locations)))
+            cost.append([dists.get(d['location'], float('inf')) for d in idle])
+        assigned = set()
+        for gi, di in min_cost_assignment(cost):
+            g, d = groups[gi], idle[di]
+            route = self.graph.route([d['location']] + g['stops'])
+            if route['distance'] == float('inf'): continue  # left unassigned: the riders wait below
+            assigned.add(gi)
+            riders = [req for _, req in g['members']]
+            try:
+                with self._claim(d, seen) as (done, _): self._assign(d, riders, g['stops'], route['distance'], done)
+            except ReservationConflict:
+                for i, req in g['members']: results[i] = self._submit(req)
+                continue
+            for i, req in g['members']:
+                if g['pair']:
+                    a, b = riders[0]['userId'], riders[1]['userId']
+                    msg = f"{a} pooled with {b} (shared route {g['pair']['overlap']*100:.1f}%)"
+                else:
+                    msg = f"Assigned {d['id']} to {req['userId']}"
+                results[i] = {'success': True, 'message': msg, 'assigned_route': route}
+
+        for gi, g in enumerate(groups):
+            if gi in assigned: continue
+            for i, req in g['members']:
+                self._enqueue(req, trips[req['id']])
+                results[i] = {'success': False, 'message': 'No drivers available; added to waiting list.'}
+        return results
+
+    @publishes
+    def arrive(self, driver_id, node):
+        # the driver reached `node` (moves come from the event simulation in simulation.py). At its next stop riders
+        # bound there get off and riders waiting there get on; the ride is over once the car is empty
+        seen = self._sync()
+        d = self._by_id.get(driver_id)
+        if not d or d['status'] != 'en-route':
+            return {'success': False, 'message': f"{driver_id} is not currently on a ride."}
+        boarded, dropped = [], []
+        with self._claim(d, seen):
+            d['location'] = node
+            if d['stops'] and d['stops'][0] == node:
+                while d['stops'] and d['stops'][0] == node: d['stops'] = d['stops'][1:]
+                dropped = [p for p in d['passengers'] if p.get('onboard') and p['destination'] == node]
+                d['passengers'] = [p for p in d['passengers'] if p not in dropped]
+                boarded = [p for p in d['passengers'] if not p.get('onboard') and p['source'] == node]
+                for p in boarded: p['onboard'] = True
+                if d['passengers'] and not d['stops']: d['stops'] = self._remaining_stops(d)  # plan lost a stop
+            if not d['passengers']:
+                d['status'], d['stops'] = 'idle', []
+                self._index_driver(d)
+            self._touch(d)
+        if d['status'] == 'idle':
+            self._log({'type': 'Completed', 'driver': driver_id, 'riders': [p['userId'] for p in dropped], 'distance': 0})
+        return {'success': True, 'boarded': [p['userId'] for p in boarded], 'dropped': [p['userId'] for p in dropped],
+                'completed': d['status'] == 'idle'}
+
+    @publishes
+    def dispatch_waiting(self):
+        # offer waiting riders, oldest first, to drivers that freed up since they arrived
+        results = []
+        for req in list(self.requests):
+            if not any(d['status'] == 'idle' for d in self.drivers): break
+            if self._dequeue(req): results.append(self._submit(req))
+        return results
+
+    @publishes
+    def complete(self, driver_id):
+        for _ in range(self.MAX_ATTEMPTS):
+            try: return self._complete(driver_id)
+            except ReservationConflict: metrics.inc('carpool_reservation_conflicts_total', op='complete')
+        return {"success": False, "message": f"{driver_id} is being updated by another request; try again."}
+
+    def _complete(self, driver_id):
+        seen = self._sync()
+        driver = self._by_id.get(driver_id)
+        if not driver:
+            return {"success": False, "message": f"Driver {driver_id} not found."}
+
+        if driver['status'] != 'en-route':
+            return {"success": False, "message": f"{driver_id} is not currently on a ride."}
+
+        # Determine the final node
+        if driver.get('stops'):
+            final_node = driver['stops'][-1]  # use last stop as final destination
+        elif driver.get('passengers'):
+            # fallback if stops are empty, use last passenger destination
+            final_node = driver['passengers'][-1]['destination']
+        else:
+            return {"success": False, "message": "Final destination not found for this ride."}
+
+        # Update driver state
+        with self._claim(driver, seen):
+            driver['location'] = final_node
+            driver['status'] = 'idle'
+            driver['passengers'] = []
+            driver['stops'] = []
+            self._index_driver(driver)
+            self._touch(driver)
+
+        # Optional: log to ride history
+        self._log({
+            'type': 'Completed',
+            'driver': driver_id,
+            'riders': [],
+            'distance': 0
+        })
+
+        loc_name = self.graph.nodes[final_node]['name']
+        return {
+            "success": True,
+            "message": f"{driver_id} completed the ride and is now idle at {loc_name}.",
+        }
@@ -1,59 +1,382 @@
 import heapq
-from typing import Dict, Any, List, Tuple
+import threading
+from array import array
+from math import hypot
+from collections import OrderedDict
+from typing import Dict, Any, List, NamedTuple, Optional, Tuple
+
+from app.contraction import ContractionHierarchy, graph_fingerprint
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 NodeId = str
 Path = List[NodeId]
+Tree = Tuple[array, array]  # (distance, predecessor index) per node index
+
+
+class CompiledGraph(NamedTuple):
+    """CSR form of the graph: node i's edges are targets/weights[offsets[i]:offsets[i + 1]]."""
+    ids: List[NodeId]
+    index: Dict[NodeId, int]
+    offsets: array
+    targets: array
+    weights: array
+
 
 class Graph:
+    CACHE_SIZE = 256
+    CACHE_MEMORY_BUDGET = 64 * 1024 * 1024  # bytes of cached trees; on large graphs fewer than CACHE_SIZE fit
+    MATRIX_MAX_NODES = 4000
+    MATRIX_MEMORY_BUDGET = 256 * 1024 * 1024
+
     def __init__(self):
         self.nodes: Dict[NodeId, Dict[str, Any]] = {}
-        self.adjacency_list: Dict[NodeId, List[Dict[str, Any]]] = {}
+        self.adjacency_list: Optional[Dict[NodeId, List[Dict[str, Any]]]] = {}
+        self.compiled: Optional[CompiledGraph] = None
+        self._trees: 'OrderedDict[NodeId, Tree]' = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.backend = 'dijkstra'
+        self._matrix = None
+        self.hierarchy: Optional[ContractionHierarchy] = None
+        self.source: Optional[str] = None  # .cgraph file the arrays are memory-mapped from (see app.loaders)
+        self._mapping = None
+        self._lock = threading.RLock()  # searches share buffers and the LRU cache, so one runs at a time
 
     def add_node(self, id: NodeId, lat: float, lng: float, name: str = None):
+        self._thaw()
         self.nodes[id] = {'id': id, 'lat': lat, 'lng': lng, 'name': name or id}
         if id not in self.adjacency_list:
             self.adjacency_list[id] = []
+        self.invalidate_cache()
 
     def add_edge(self, u: NodeId, v: NodeId, weight: float):
+        self._thaw()
         if u not in self.adjacency_list: self.adjacency_list[u] = []
         if v not in self.adjacency_list: self.adjacency_list[v] = []
         self.adjacency_list[u].append({'node': v, 'weight': weight})
         self.adjacency_list[v].append({'node': u, 'weight': weight})
+        self.invalidate_cache()
 
     def get_node(self, id: NodeId):
         return self.nodes.get(id)
 
-    def dijkstra(self, source: NodeId, target: NodeId):
-        distances = {node: float('inf') for node in self.nodes}
-        previous = {node: None for node in self.nodes}
+    def invalidate_cache(self):
+        self._trees.clear()
+        self._matrix = None
+        self.hierarchy = None
+
+    def freeze(self) -> CompiledGraph:
+        """Compile the adjacency lists into CSR arrays and release them; mutating the graph thaws it again."""
+        if self.compiled is not None:
+            return self.compiled
+        ids = list(self.nodes) + [n for n in self.adjacency_list if n not in self.nodes]
+        index = {node: i for i, node in enumerate(ids)}
+        offsets, targets, weights = array('l', [0]), array('l'), array('d')
+        for node in ids:
+            for n in self.adjacency_list.get(node, []):
+                targets.append(index[n['node']])
+                weights.append(n['weight'])
+            offsets.append(len(targets))
+        self.compiled = CompiledGraph(ids, index, offsets, targets, weights)
+        self._allocate()
+        self._calibrate_heuristic()
+        return self.compiled
+
+    def load_compiled(self, nodes, ids, index, offsets, targets, weights, lat, lng, heuristic_scale: float,
+                      source: str = None, mapping=None):
+        """Adopt ready-made CSR arrays and coordinates, e.g. memory-mapped by app.loaders.load_binary.
+
+        `mapping` is the mmap the arrays are views of (kept open while the graph uses them), `source` its file.
+        """
+        self.__init__()
+        self.nodes, self.source, self._mapping = nodes, source, mapping
+        self.compiled = CompiledGraph(ids, index, offsets, targets, weights)
+        self._allocate()
+        self._lat, self._lng, self.heuristic_scale = lat, lng, heuristic_scale
+
+    def _allocate(self):
+        self.adjacency_list = None
+        n = len(self.compiled.ids)
+        # search buffers shared by every query; a search resets only the entries it touched
+        self._distances = array('d', [float('inf')]) * n
+        self._previous = array('l', [-1]) * n
+        self._distances_back = array('d', self._distances)
+        self._previous_back = array('l', self._previous)
+
+    def _calibrate_heuristic(self):
+        """Scale straight-line lat/lng distance into edge-weight units without ever overestimating."""
+        ids, _, offsets, targets, weights = self.compiled
+        self._lat = array('d', [self.nodes[n]['lat'] if n in self.nodes else 0.0 for n in ids])
+        self._lng = array('d', [self.nodes[n]['lng'] if n in self.nodes else 0.0 for n in ids])
+        scale = float('inf')
+        for u in range(len(ids)):
+            for e in range(offsets[u], offsets[u + 1]):
+                length = hypot(self._lat[u] - self._lat[targets[e]], self._lng[u] - self._lng[targets[e]])
+                if length > 0:
+                    scale = min(scale, weights[e] / length)
+        if scale == float('inf') or len(ids) > len(self.nodes):
+            scale = 0.0  # no usable geometry: A* degrades to plain Dijkstra
+        self.heuristic_scale = scale
+
+    def _thaw(self):
+        if self.compiled is None:
+            return
+        ids, _, offsets, targets, weights = self.compiled
+        self.nodes, self.source, self._mapping = dict(self.nodes), None, None  # a loaded node table is read-only
+        self.adjacency_list = {
+            node: [{'node': ids[targets[e]], 'weight': weights[e]} for e in range(offsets[i], offsets[i + 1])]
+            for i, node in enumerate(ids)
+        }
+        self.compiled = None
+
+    def cache_info(self) -> Dict[str, int]:
+        return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                'size': len(self._trees), 'maxsize': self.cache_capacity()}
+
+    def cache_capacity(self) -> int:
+        """Trees kept: CACHE_SIZE, or as many as fit CACHE_MEMORY_BUDGET when each is a pair of O(n) arrays."""
+        tree_bytes = (array('d').itemsize + array('l').itemsize) * max(1, len(self.freeze().ids))
+        return max(1, min(self.CACHE_SIZE, self.CACHE_MEMORY_BUDGET // tree_bytes))
+
+    def shortest_path_tree(self, source: NodeId) -> Tree:
+        if source in self._trees:
+            self.cache_hits += 1
+            self._trees.move_to_end(source)
+            return self._trees[source]
+        self.cache_misses += 1
+        self._trees[source] = self._single_source(self.freeze().index[source])
+        if len(self._trees) > self.cache_capacity():
+            self._trees.popitem(last=False)
+        return self._trees[source]
+
+    def _single_source(self, source: int) -> Tree:
+        _, _, offsets, targets, weights = self.freeze()
+        distances, previous = self._distances, self._previous
+        touched = [source]
         pq = [(0.0, source)]
         distances[source] = 0.0
         while pq:
             dist, node = heapq.heappop(pq)
+            if dist > distances[node]:
+                continue
+            for e in range(offsets[node], offsets[node + 1]):
+                n, new_dist = targets[e], dist + weights[e]
+                if new_dist < distances[n]:
+                    if distances[n] == float('inf'):
+                        touched.append(n)
+                    distances[n] = new_dist
+                    previous[n] = node
+                    heapq.heappush(pq, (new_dist, n))
+        tree = (array('d', distances), array('l', previous))
+        self._reset(touched)
+        return tree
+
+    def _reset(self, touched: List[int], distances: array = None, previous: array = None):
+        distances = self._distances if distances is None else distances
+        previous = self._previous if previous is None else previous
+        for i in touched:
+            distances[i] = float('inf')
+            previous[i] = -1
+
+    def _unwind(self, previous: array, node: int) -> Path:
+        ids = self.compiled.ids
+        path = []
+        while node != -1:
+            path.append(ids[node])
+            node = previous[node]
+        path.reverse()
+        return path
+
+    def _astar(self, source: int, target: int):
+        _, _, offsets, targets, weights = self.compiled
+        lat, lng, scale = self._lat, self._lng, self.heuristic_scale
+        target_lat, target_lng = lat[target], lng[target]
+        distances, previous = self._distances, self._previous
+        touched = [source]
+        distances[source] = 0.0
+        pq = [(scale * hypot(lat[source] - target_lat, lng[source] - target_lng), 0.0, source)]
+        while pq:
+            _, dist, node = heapq.heappop(pq)
             if dist > distances[node]:
                 continue
             if node == target:
                 break
-            for n in self.adjacency_list.get(node, []):
-                new_dist = dist + n['weight']
-                if new_dist < distances[n['node']]:
-                    distances[n['node']] = new_dist
-                    previous[n['node']] = node
-                    heapq.heappush(pq, (new_dist, n['node']))
-        path = []
-        current = target
-        while current is not None:
-            path.insert(0, current)
-            current = previous[current]
-        return {'distance': distances[target], 'path': path}
+            for e in range(offsets[node], offsets[node + 1]):
+                n, new_dist = targets[e], dist + weights[e]
+                if new_dist < distances[n]:
+                    if distances[n] == float('inf'):
+                        touched.append(n)
+                    distances[n] = new_dist
+                    previous[n] = node
+                    estimate = new_dist + scale * hypot(lat[n] - target_lat, lng[n] - target_lng)
+                    heapq.heappush(pq, (estimate, new_dist, n))
+        result = {'distance': distances[target], 'path': self._unwind(previous, target)}
+        self._reset(touched)
+        return result
+
+    def _bidirectional(self, source: int, target: int):
+        ids, _, offsets, targets, weights = self.compiled
+        distances = (self._distances, self._distances_back)
+        previous = (self._previous, self._previous_back)
+        settled = (set(), set())
+        touched = ([source], [target])
+        pq = ([(0.0, source)], [(0.0, target)])
+        distances[0][source] = distances[1][target] = 0.0
+        best, meeting = float('inf'), -1
+        if source == target:
+            best, meeting = 0.0, source
+        while pq[0] and pq[1] and pq[0][0][0] + pq[1][0][0] < best:
+            side = 0 if pq[0][0][0] <= pq[1][0][0] else 1
+            dist, node = heapq.heappop(pq[side])
+            if node in settled[side]:
+                continue
+            settled[side].add(node)
+            for e in range(offsets[node], offsets[node + 1]):
+                n, new_dist = targets[e], dist + weights[e]
+                if new_dist < distances[side][n]:
+                    if distances[side][n] == float('inf'):
+                        touched[side].append(n)
+                    distances[side][n] = new_dist
+                    previous[side][n] = node
+                    heapq.heappush(pq[side], (new_dist, n))
+                if new_dist + distances[1 - side][n] < best:
+                    best, meeting = new_dist + distances[1 - side][n], n
+        if meeting == -1:
+            result = {'distance': float('inf'), 'path': [ids[target]]}
+        else:
+            back = self._unwind(previous[1], meeting)
+            back.reverse()
+            result = {'distance': best, 'path': self._unwind(previous[0], meeting) + back[1:]}
+        for side in (0, 1):
+            self._reset(touched[side], distances[side], previous[side])
+        return result
+
+    def matrix_bytes(self) -> int:
+        n = len(self.nodes)
+        return n * n * (8 + 4)
+
+    def select_backend(self, backend: str = 'auto', max_nodes: int = None, memory_budget: int = None) -> str:
+        if backend == 'auto':
+            max_nodes = self.MATRIX_MAX_NODES if max_nodes is None else max_nodes
+            memory_budget = self.MATRIX_MEMORY_BUDGET if memory_budget is None else memory_budget
+            fits = len(self.nodes) <= max_nodes and self.matrix_bytes() <= memory_budget
+            backend = 'matrix' if np is not None and fits else 'dijkstra'
+        if backend not in ('dijkstra', 'matrix', 'ch'):
+            raise ValueError(f'Unknown routing backend: {backend}')
+        if backend == 'matrix':
+            if np is None:
+                raise RuntimeError('The matrix routing backend requires numpy')
+            self._build_matrix()
+        if backend == 'ch' and self.hierarchy is None:
+            self.hierarchy = ContractionHierarchy.build(self)
+        self.backend = backend
+        return backend
+
+    def load_hierarchy(self, path: str):
+        """Route with a prebuilt contraction hierarchy artifact (see app.contraction)."""
+        hierarchy = ContractionHierarchy.load(path)
+        if hierarchy.fingerprint != graph_fingerprint(self.freeze()):
+            raise ValueError(f'{path} was built for a different graph')
+        self.hierarchy = hierarchy
+        self.backend = 'ch'
+
+    def _build_matrix(self):
+        n = len(self.freeze().ids)
+        distances = np.full((n, n), np.inf)
+        next_hop = np.full((n, n), -1, dtype=np.int32)
+        for j in range(n):
+            # undirected graph: the tree rooted at the target holds every node's next hop towards it
+            dist, previous = self._single_source(j)
+            distances[:, j] = np.frombuffer(dist)
+            next_hop[:, j] = np.frombuffer(previous, dtype=np.dtype(f'i{previous.itemsize}'))
+        self._matrix = (distances, next_hop)
+
+    def _matrix_lookup(self, i: int, j: int):
+        if self._matrix is None:
+            self._build_matrix()
+        ids = self.compiled.ids
+        distances, next_hop = self._matrix
+        dist = float(distances[i, j])
+        if dist == float('inf'):
+            return {'distance': dist, 'path': [ids[j]]}
+        path = [ids[i]]
+        while i != j:
+            i = int(next_hop[i, j])
+            path.append(ids[i])
+        return {'distance': dist, 'path': path}
+
+    def dijkstra(self, source: NodeId, target: NodeId, method: str = None):
+        """Shortest path; method 'astar' or 'bidirectional' overrides the backend for a point-to-point search."""
+        with self._lock:
+            return self._dijkstra(source, target, method)
+
+    def _dijkstra(self, source: NodeId, target: NodeId, method: str = None):
+        index = self.freeze().index
+        if source not in index or target not in index:
+            return {'distance': float('inf'), 'path': [target]}
+        if method == 'astar':
+            return self._astar(index[source], index[target])
+        if method == 'bidirectional':
+            return self._bidirectional(index[source], index[target])
+        if method is not None:
+            raise ValueError(f'Unknown search method: {method}')
+        if self.backend == 'matrix':
+            return self._matrix_lookup(index[source], index[target])
+        if self.backend == 'ch':
+            if self.hierarchy is None:
+                self.hierarchy = ContractionHierarchy.build(self)
+            return self.hierarchy.query(source, target)
+        distances, previous = self.shortest_path_tree(source)
+        return {'distance': distances[index[target]], 'path': self._unwind(previous, index[target])}
+
+    def nearest_targets(self, source: NodeId, targets, k: int = 1) -> List[Tuple[NodeId, float]]:
+        with self._lock:
+            return self._nearest_targets(source, targets, k)
+
+    def _nearest_targets(self, source: NodeId, targets, k: int = 1) -> List[Tuple[NodeId, float]]:
+        ids, index, offsets, edge_targets, weights = self.freeze()
+        if source not in index:
+            return []
+        if self.backend in ('matrix', 'ch') or source in self._trees:
+            found = [(t, self.dijkstra(source, t)['distance']) for t in set(targets) if t in index]
+            return sorted([f for f in found if f[1] < float('inf')], key=lambda f: f[1])[:k]
+        # a single search from the source that stops as soon as k targets have been settled
+        wanted = {index[t] for t in targets if t in index}
+        distances = self._distances
+        start = index[source]
+        settled = set()
+        touched = [start]
+        found: List[Tuple[NodeId, float]] = []
+        pq = [(0.0, start)]
+        distances[start] = 0.0
+        while pq and len(found) < k:
+            dist, node = heapq.heappop(pq)
+            if node in settled:
+                continue
+            settled.add(node)
+            if node in wanted:
+                found.append((ids[node], dist))
+            for e in range(offsets[node], offsets[node + 1]):
+                n, new_dist = edge_targets[e], dist + weights[e]
+                if new_dist < distances[n]:
+                    if distances[n] == float('inf'):
+                        touched.append(n)
+                    distances[n] = new_dist
+                    heapq.heappush(pq, (new_dist, n))
+        self._reset(touched)
+        return found
 
-    def get_multi_segment_route(self, stops: List[NodeId]):
+    def get_multi_segment_route(self, stops: List[NodeId], method: str = None):
         total = 0.0
         path: Path = []
         if len(stops) < 2:
             return {'distance': 0.0, 'path': []}
         for i in range(len(stops) - 1):
-            seg = self.dijkstra(stops[i], stops[i + 1])
+            seg = self.dijkstra(stops[i], stops[i + 1], method)
             total += seg['distance']
             path.extend(seg['path'] if i == 0 else seg['path'][1:])
         return {'distance': total, 'path': path}
@@ -0,0 +1,138 @@
+"""Bounded ride history: recent entries in memory, everything in an append-only SQLite log."""
+import atexit
+import json
+import os
+import tempfile
+import threading
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+try:  # next to app.py (see its imports) or inside the package
+    from store import LocalConnection
+except ImportError:
+    from app.store import LocalConnection
+
+Entry = Dict[str, Any]
+
+
+def temporary_log() -> str:
+    """Path of a fresh SQLite log in the temp directory, deleted at exit: for servers given no CARPOOL_HISTORY_DB,
+    so entries past the in-memory ring are still paged from disk."""
+    fd, path = tempfile.mkstemp(prefix='carpool-history-', suffix='.db')
+    os.close(fd)
+    atexit.register(_remove, path)
+    return path
+
+
+def _remove(path: str):
+    for name in (path, path + '-wal', path + '-shm'):
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+
+def _empty_totals() -> Dict[str, float]:
+    return {'rides': 0, 'pooled': 0, 'completed': 0, 'distance': 0.0}
+
+
+class RideHistory:
+    RECENT = 200  # entries kept in memory and sent with /status
+    PAGE_LIMIT = 100  # largest page /history hands out
+
+    def __init__(self, path: Optional[str] = None, recent: Optional[int] = None):
+        self._recent = deque(maxlen=recent or self.RECENT)  # (seq, version, entry), oldest first
+        self._lock = threading.Lock()
+        self.path = path
+        self._connect = LocalConnection(path) if path else None
+        self.totals: Dict[str, Dict[str, float]] = {}  # driver -> running totals (kept in the database when logging)
+        self.seq = 0
+        if path:
+            db = self._connect()
+            db.execute('CREATE TABLE IF NOT EXISTS history (seq INTEGER PRIMARY KEY AUTOINCREMENT, entry TEXT NOT NULL)')
+            db.execute('CREATE TABLE IF NOT EXISTS history_totals (driver TEXT PRIMARY KEY, rides INTEGER, '
+                       'pooled INTEGER, completed INTEGER, distance REAL)')
+            self.seq = db.execute('SELECT COALESCE(MAX(seq), 0) FROM history').fetchone()[0]
+
+    @staticmethod
+    def _delta(entry: Entry) -> Dict[str, float]:
+        # 'Assigned', or 'Pooled' for a group, starts a ride with its planned distance; a 'Pooled' entry with
+        # 'added' is a rider joining a ride under way and adds only the extra distance, so each ride counts once
+        kind, joined = entry.get('type'), 'added' in entry
+        starts = kind in ('Assigned', 'Pooled') and not joined
+        return {'rides': int(starts), 'pooled': int(kind == 'Pooled' and (starts or bool(entry.get('newlyPooled')))),
+                'completed': int(kind == 'Completed'),
+                'distance': (entry['added'] if joined else entry.get('distance')) or 0.0}
+
+    def append(self, entry: Entry, version: int = 0) -> int:
+        """Record an entry (tagged with the simulator version that produced it) and return its sequence number."""
+        delta = self._delta(entry)
+        with self._lock:
+            if self.path:
+                db = self._connect()
+                db.execute('BEGIN IMMEDIATE')
+                try:
+                    seq = db.execute('INSERT INTO history (entry) VALUES (?)', (json.dumps(entry),)).lastrowid
+                    db.execute('INSERT INTO history_totals VALUES (:driver, :rides, :pooled, :completed, :distance) '
+                               'ON CONFLICT(driver) DO UPDATE SET rides = rides + :rides, pooled = pooled + :pooled, '
+                               'completed = completed + :completed, distance = distance + :distance',
+                               {'driver': entry.get('driver'), **delta})
+                except BaseException:
+                    db.execute('ROLLBACK')
+                    raise
+                db.execute('COMMIT')
+            else:
+                seq = self.seq + 1
+                totals = self.totals.setdefault(entry.get('driver'), _empty_totals())
+                for key, value in delta.items():
+                    totals[key] += value
+            self.seq = max(self.seq, seq)
+            self._recent.append((seq, version, entry))
+        return seq
+
+    def __len__(self) -> int:
+        return self.seq  # entries recorded, not just the ones still in memory
+
+    def recent(self) -> List[Entry]:
+        with self._lock:
+            return [entry for _, _, entry in self._recent]
+
+    def since(self, version: int) -> List[Entry]:
+        """Recent entries newer than `version`; anything older than the ring is only available from page()."""
+        out = []
+        with self._lock:
+            for _, v, entry in reversed(self._recent):
+                if v <= version:
+                    break
+                out.append(entry)
+        return out[::-1]
+
+    def page(self, before: Optional[int] = None, limit: int = 50) -> Dict[str, Any]:
+        """Entries newest first, each with its `seq`; pass the returned `next` as `before` for the following page."""
+        limit = max(1, min(limit, self.PAGE_LIMIT))
+        if self.path:  # the log may be shared with other workers, so it is the authority on what exists
+            rows = self._connect().execute('SELECT seq, entry FROM history WHERE seq < ? ORDER BY seq DESC LIMIT ?',
+                                           (2 ** 63 - 1 if before is None else before, limit)).fetchall()
+            entries = [{'seq': seq, **json.loads(entry)} for seq, entry in rows]
+            oldest = 1
+        else:  # only the ring is left: older entries were dropped, so paging ends at its oldest entry
+            before = self.seq + 1 if before is None else before
+            with self._lock:
+                entries = [{'seq': seq, **entry} for seq, _, entry in reversed(self._recent) if seq < before][:limit]
+                oldest = self._recent[0][0] if self._recent else 0
+        more = len(entries) == limit and entries[-1]['seq'] > oldest
+        return {'entries': entries, 'next': entries[-1]['seq'] if more else None}
+
+    def stats(self) -> Dict[str, Any]:
+        if self.path:
+            rows = self._connect().execute('SELECT * FROM history_totals WHERE driver IS NOT NULL').fetchall()
+            drivers = {d: {'rides': r, 'pooled': p, 'completed': c, 'distance': dist} for d, r, p, c, dist in rows}
+        else:
+            with self._lock:
+                drivers = {d: dict(t) for d, t in self.totals.items() if d is not None}
+        overall = _empty_totals()
+        for t in drivers.values():
+            for key in overall:
+                overall[key] += t[key]
+        return {**overall, 'pooledRatio': overall['pooled'] / overall['rides'] if overall['rides'] else 0.0,
+                'drivers': drivers}
@@ -0,0 +1,273 @@
+"""Road graphs beyond SAMPLE_GRAPH: file loaders, synthetic cities and a memory-mappable binary format."""
+import argparse
+import csv
+import json
+import math
+import mmap
+import random
+from array import array
+from collections.abc import Mapping
+
+MAGIC = b'CARPOOL-GRAPH 1\n'
+ALIGN = 8
+
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+    return 12742.0 * math.asin(math.sqrt(a))
+
+
+class NodeTable(Mapping):
+    """Read-only node records ({'id', 'lat', 'lng', 'name'}) built on access from memory-mapped columns."""
+
+    def __init__(self, ids, index, lat, lng, names=None, located=None):
+        self.ids, self.index, self.lat, self.lng, self.names = ids, index, lat, lng, names
+        self._len = len(ids) if located is None else located  # nodes without coordinates are not listed
+
+    def __getitem__(self, node):
+        i = self.index[node]
+        if math.isnan(self.lat[i]):
+            raise KeyError(node)
+        return {'id': node, 'lat': self.lat[i], 'lng': self.lng[i], 'name': self.names[i] if self.names else node}
+
+    def __contains__(self, node):
+        i = self.index.get(node)
+        return i is not None and not math.isnan(self.lat[i])
+
+    def __iter__(self):
+        return (n for i, n in enumerate(self.ids) if not math.isnan(self.lat[i]))
+
+    def __len__(self):
+        return self._len
+
+
+def load_json(path: str, graph):
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('type') == 'FeatureCollection':
+        return _geojson(data, graph)
+    for node in data['nodes']:
+        graph.add_node(node['id'], node['lat'], node['lng'], node.get('name'))
+    for edge in data['edges']:
+        graph.add_edge(edge['u'], edge['v'], edge['weight'])
+    return graph
+
+
+def load_edge_list(path: str, graph, delimiter: str = None):
+    """`u v [weight]` per line (weight defaults to 1); lines starting with # or % are comments."""
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line[0] in '#%':
+                continue
+            parts = line.split(delimiter)
+            graph.add_edge(parts[0].strip(), parts[1].strip(), float(parts[2]) if len(parts) > 2 else 1.0)
+    return graph
+
+
+def load_nodes_csv(path: str, graph):
+    """id,lat,lng[,name] rows: the coordinates edge lists and edge CSVs do not carry."""
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            graph.add_node(row['id'], float(row['lat']), float(row['lng']), row.get('name') or None)
+    return graph
+
+
+def load_csv(edges_path: str, graph, nodes_path: str = None):
+    if nodes_path:
+        load_nodes_csv(nodes_path, graph)
+    with open(edges_path, newline='') as f:
+        for row in csv.DictReader(f):
+            graph.add_edge(row['u'], row['v'], float(row.get('weight') or row['length']))
+    return graph
+
+
+def load_geojson(path: str, graph):
+    with open(path) as f:
+        return _geojson(json.load(f), graph)
+
+
+def _geojson(data, graph):
+    # roads are LineStrings; their vertices become nodes (shared coordinates join roads) and each segment
+    # an edge weighted by its length in km. Named Points label the node at the same coordinate.
+    def node(lng, lat, name=None):
+        key = f'{lat:.6f},{lng:.6f}'
+        if key not in known or name:
+            graph.add_node(key, lat, lng, name)
+            known.add(key)
+        return key
+
+    known = set()
+    for feature in data['features']:
+        geometry, props = feature.get('geometry') or {}, feature.get('properties') or {}
+        if geometry.get('type') == 'Point':
+            node(*geometry['coordinates'][:2], name=props.get('name'))
+        lines = {'LineString': [geometry.get('coordinates')],
+                 'MultiLineString': geometry.get('coordinates')}.get(geometry.get('type'), [])
+        for line in lines:
+            for (lng1, lat1, *_), (lng2, lat2, *_) in zip(line, line[1:]):
+                graph.add_edge(node(lng1, lat1), node(lng2, lat2), haversine_km(lat1, lng1, lat2, lng2))
+    return graph
+
+
+def grid_city(graph, rows: int, cols: int, spacing: float = 0.002, origin=(40.70, -74.02),
+              jitter: float = 0.2, seed: int = 0):
+    """rows x cols street grid; `jitter` randomly lengthens blocks so shortest paths are not all ties."""
+    rng = random.Random(seed)
+    for r in range(rows):
+        for c in range(cols):
+            graph.add_node(f'{r}-{c}', origin[0] + r * spacing, origin[1] + c * spacing)
+    for r in range(rows):
+        for c in range(cols):
+            lat, lng = origin[0] + r * spacing, origin[1] + c * spacing
+            if c + 1 < cols:
+                graph.add_edge(f'{r}-{c}', f'{r}-{c + 1}', haversine_km(lat, lng, lat, lng + spacing) * (1 + rng.uniform(0, jitter)))
+            if r + 1 < rows:
+                graph.add_edge(f'{r}-{c}', f'{r + 1}-{c}', haversine_km(lat, lng, lat + spacing, lng) * (1 + rng.uniform(0, jitter)))
+    return graph
+
+
+def random_geometric_city(graph, n: int, degree: float = 6.0, size: float = 0.1, origin=(40.70, -74.02),
+                          seed: int = 0):
+    """n random intersections in a size x size degree box, joined when closer than the radius that gives
+    about `degree` roads per intersection; only the largest connected part is kept."""
+    rng = random.Random(seed)
+    pts = [(origin[0] + rng.random() * size, origin[1] + rng.random() * size) for _ in range(n)]
+    radius = size * math.sqrt(degree / (math.pi * n))
+    cells = {}
+    for i, (lat, lng) in enumerate(pts):
+        cells.setdefault((math.floor(lat / radius), math.floor(lng / radius)), []).append(i)
+    edges, adj = [], [[] for _ in range(n)]
+    for (row, col), members in cells.items():
+        for dr in (-1, 0, 1):
+            for dc in (-1, 0, 1):
+                for j in cells.get((row + dr, col + dc), ()):
+                    for i in members:
+                        if i < j and math.hypot(pts[i][0] - pts[j][0], pts[i][1] - pts[j][1]) <= radius:
+                            edges.append((i, j))
+                            adj[i].append(j)
+                            adj[j].append(i)
+    component, seen = [], [False] * n
+    for start in range(n):
+        if seen[start]:
+            continue
+        part, stack, seen[start] = [], [start], True
+        while stack:
+            u = stack.pop()
+            part.append(u)
+            for v in adj[u]:
+                if not seen[v]:
+                    seen[v] = True
+                    stack.append(v)
+        if len(part) > len(component):
+            component = part
+    keep = set(component)
+    for i in sorted(keep):
+        graph.add_node(f'n{i}', *pts[i])
+    for i, j in edges:
+        if i in keep:
+            graph.add_edge(f'n{i}', f'n{j}', haversine_km(*pts[i], *pts[j]))
+    return graph
+
+
+def save_binary(graph, path: str):
+    """Write the frozen graph's CSR arrays, coordinates and ids in the layout load_binary() maps."""
+    ids, _, offsets, targets, weights = graph.freeze()
+    nodes = graph.nodes
+    lat = array('d', [nodes[n]['lat'] if n in nodes else math.nan for n in ids])
+    lng = array('d', [nodes[n]['lng'] if n in nodes else math.nan for n in ids])
+    names = [nodes[n]['name'] if n in nodes else n for n in ids]
+    sections = [('lat', lat), ('lng', lng), ('offsets', array('q', offsets)), ('targets', array('q', targets)),
+                ('weights', array('d', weights)), ('ids', array('B', '\n'.join(ids).encode()))]
+    if any(name != n for name, n in zip(names, ids)):
+        sections.append(('names', array('B', '\n'.join(names).encode())))
+    header = {'nodes': len(ids), 'located': sum(1 for n in ids if n in nodes),
+              'heuristic_scale': getattr(graph, 'heuristic_scale', 0.0),
+              'sections': [[name, arr.typecode, len(arr)] for name, arr in sections]}
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(json.dumps(header).encode() + b'\n')
+        for _, arr in sections:
+            f.write(b'\0' * (-f.tell() % ALIGN))
+            f.write(arr.tobytes())
+
+
+def load_binary(path: str, graph):
+    """Map a save_binary() file into `graph`; the arrays stay backed by the page cache, shared between processes."""
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if mm.readline() != MAGIC:
+        raise ValueError(f'{path} is not a carpool graph file')
+    header = json.loads(mm.readline())
+    view, pos, arrays = memoryview(mm), mm.tell(), {}
+    for name, typecode, length in header['sections']:
+        pos += -pos % ALIGN
+        size = length * array(typecode).itemsize
+        arrays[name] = view[pos:pos + size].cast(typecode)
+        pos += size
+    ids = bytes(arrays['ids']).decode().split('\n') if header['nodes'] else []
+    names = bytes(arrays['names']).decode().split('\n') if 'names' in arrays else None
+    index = {n: i for i, n in enumerate(ids)}
+    nodes = NodeTable(ids, index, arrays['lat'], arrays['lng'], names, header['located'])
+    lat, lng = arrays['lat'], arrays['lng']
+    if header['located'] < header['nodes']:  # the heuristic is off (scale 0) but must not see NaN coordinates
+        lat = lng = array('d', bytes(8 * header['nodes']))
+    # the source path lets the graph pickle as a path, so worker processes map the same pages
+    graph.load_compiled(nodes, ids, index, arrays['offsets'], arrays['targets'], arrays['weights'],
+                        lat, lng, header['heuristic_scale'], source=path, mapping=mm)
+    return graph
+
+
+def load_graph(spec: str, graph):
+    """Fill `graph` from a spec and return it.
+
+        grid:ROWSxCOLS          synthetic grid city
+        rgg:N                   synthetic random geometric city with N nodes
+        path.cgraph             binary format written by save_binary() (python -m app.loaders converts)
+        path.geojson            LineString roads (weights are segment lengths in km)
+        path.json               SAMPLE_GRAPH-style {"nodes": [...], "edges": [...]}
+        edges.csv,nodes.csv     u,v,weight columns; nodes need id,lat,lng[,name]
+        edges.txt,nodes.csv     whitespace-separated `u v [weight]` edge list (any other file name)
+
+    Drivers and riders are placed by coordinates, so a spec that locates no node at all (an edge list or
+    edge CSV without its nodes file) is refused.
+    """
+    kind, _, arg = spec.partition(':')
+    edges, _, nodes = spec.partition(',')
+    if kind == 'grid' and arg:
+        rows, _, cols = arg.partition('x')
+        grid_city(graph, int(rows), int(cols or rows))
+    elif kind == 'rgg' and arg:
+        random_geometric_city(graph, int(arg))
+    elif spec.endswith('.cgraph'):
+        load_binary(spec, graph)
+    elif spec.endswith('.geojson'):
+        load_geojson(spec, graph)
+    elif spec.endswith('.json'):
+        load_json(spec, graph)
+    elif edges.endswith('.csv'):
+        load_csv(edges, graph, nodes or None)
+    else:
+        load_edge_list(edges, graph)
+        if nodes:
+            load_nodes_csv(nodes, graph)
+    if not graph.nodes:
+        raise ValueError(f'{spec}: no node has coordinates; add a nodes file (edges,nodes.csv)')
+    return graph
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert a road graph into the memory-mappable .cgraph format.')
+    parser.add_argument('source', help='graph spec, e.g. roads.geojson, edges.csv,nodes.csv or grid:1000x1000')
+    parser.add_argument('output', help='where to write the .cgraph file')
+    args = parser.parse_args(argv)
+
+    from app.graph import Graph
+    graph = load_graph(args.source, Graph())
+    graph.freeze()
+    save_binary(graph, args.output)
+    print(f"{len(graph.compiled.ids)} nodes, {len(graph.compiled.targets) // 2} roads -> {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""In-process counters and timers, rendered in the Prometheus text format for /metrics."""
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _key(labels: Dict[str, object]) -> Labels:
+    # call sites pass labels in a fixed order, so the key skips sorting; values are stringified at render time
+    return tuple(labels.items())
+
+
+def _fmt(name: str, labels: Labels, extra: Labels = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return name
+    inner = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs)
+    return f'{name}{{{inner}}}'
+
+
+class _Local(threading.local):
+    profile = None  # a class default: a missing-attribute lookup on a thread-local costs more than the update itself
+
+
+class Metrics:
+    BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)  # seconds; searches span microseconds to seconds
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = defaultdict(dict)
+        self._histograms: Dict[str, Dict[Labels, List[float]]] = defaultdict(dict)  # bucket counts, then sum
+        self._help: Dict[str, str] = {}
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, Dict[str, object], float]]]] = []
+        self._local = _Local()
+
+    def describe(self, name: str, text: str):
+        self._help[name] = text
+
+    def register(self, collector: Callable[[], Iterable[Tuple[str, str, Dict[str, object], float]]]):
+        """collector() -> [(name, 'counter' | 'gauge', labels, value)], read on every scrape."""
+        self._collectors.append(collector)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _key(labels)
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + value
+        profile = self._local.profile
+        if profile is not None:
+            profile['counts'][_fmt(name, key)] += value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = _key(labels)
+        with self._lock:
+            series = self._histograms[name]
+            if key not in series:
+                series[key] = [0] * (len(self.BUCKETS) + 2)
+            h = series[key]
+            h[bisect_left(self.BUCKETS, seconds)] += 1  # one past the last bound is the +Inf bucket
+            h[-1] += seconds
+        profile = self._local.profile
+        if profile is not None:
+            profile['ms'][_fmt(name, key)] += seconds * 1000
+
+    def timer(self, name: str, **labels) -> '_Timer':
+        return _Timer(self, name, labels)
+
+    def start_profile(self) -> Dict[str, Dict[str, float]]:
+        """Also collect what this thread records into {'ms': {series: total}, 'counts': {series: total}}."""
+        self._local.profile = {'ms': defaultdict(float), 'counts': defaultdict(float)}
+        return self._local.profile
+
+    def stop_profile(self) -> Dict[str, Dict[str, float]]:
+        profile, self._local.profile = self._local.profile, None
+        return profile
+
+    @contextmanager
+    def profile(self):
+        started = self.start_profile()
+        try:
+            yield started
+        finally:
+            self.stop_profile()
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: {k: list(h) for k, h in series.items()} for name, series in self._histograms.items()}
+        collected = defaultdict(list)
+        for collector in self._collectors:
+            for name, kind, labels, value in collector():
+                collected[(name, kind)].append((_key(labels), value))
+        counters = {name: {tuple(sorted(k)): v for k, v in series.items()} for name, series in counters.items()}
+        histograms = {name: {tuple(sorted(k)): h for k, h in series.items()} for name, series in histograms.items()}
+        for name, series in sorted(counters.items()):
+            lines += self._header(name, 'counter')
+            lines += [f'{_fmt(name, k)} {v}' for k, v in sorted(series.items())]
+        for (name, kind), series in sorted(collected.items()):
+            lines += self._header(name, kind)
+            lines += [f'{_fmt(name, k)} {v}' for k, v in sorted(series)]
+        for name, series in sorted(histograms.items()):
+            lines += self._header(name, 'histogram')
+            for k, h in sorted(series.items()):
+                running = 0
+                for bound, n in zip(self.BUCKETS, h):
+                    running += n
+                    lines.append(f"{_fmt(name + '_bucket', k, (('le', repr(bound)),))} {running}")
+                count = running + h[len(self.BUCKETS)]
+                lines.append(f"{_fmt(name + '_bucket', k, (('le', '+Inf'),))} {count}")
+                lines.append(f'{_fmt(name + "_sum", k)} {h[-1]}')
+                lines.append(f'{_fmt(name + "_count", k)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, name: str, kind: str) -> List[str]:
+        help_line = [f'# HELP {name} {self._help[name]}'] if name in self._help else []
+        return help_line + [f'# TYPE {name} {kind}']
+
+
+class _Timer:
+    # a plain context manager rather than @contextmanager, which costs a generator per timed call
+    __slots__ = ('metrics', 'name', 'labels', 'started')
+
+    def __init__(self, metrics: Metrics, name: str, labels: Dict[str, object]):
+        self.metrics, self.name, self.labels = metrics, name, labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
@@ -12,3 +12,8 @@ def submit_request():
     data = request.json
     res = simulator.submit_request(data.get('userId'), data.get('source'), data.get('destination'))
     return jsonify({**res, 'state': simulator.get_full_status()})
+
+@routes_bp.route('/history', methods=['GET'])
+def history():
+    page = simulator.history.page(request.args.get('before', type=int), request.args.get('limit', 50, type=int))
+    return jsonify({**page, 'stats': simulator.history.stats()})
@@ -0,0 +1,245 @@
+"""Seeded discrete-event simulation of CarpoolSimulator, and the benchmark scenarios CI compares against a baseline."""
+import argparse
+import heapq
+import json
+import random
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+try:
+    from app.engine import CarpoolSimulator
+except ImportError:  # run next to app.py, where `app` is the server module itself
+    from engine import CarpoolSimulator
+
+# name -> settings for run_scenario(); rate is riders per simulated minute, graph a loaders spec (default: sample)
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    'smoke': {'riders': 200, 'fleet': 5, 'rate': 0.5},
+    'rush': {'riders': 1000, 'fleet': 10, 'rate': 3.0, 'hotspots': 3},
+    'city': {'riders': 300, 'fleet': 30, 'rate': 2.0, 'graph': 'grid:30x30'},
+}
+
+
+def _dedup(stops) -> tuple:
+    # consecutive visits to the same node are one stop
+    return tuple(s for k, s in enumerate(stops) if k == 0 or s != stops[k - 1])
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class EventSimulation:
+    SPEED = 0.5  # edge-weight units driven per simulated minute (~30 km/h on the sample graph)
+
+    def __init__(self, sim: CarpoolSimulator, seed: int = 0, rate: float = 1.0,
+                 origins: Optional[Dict[str, float]] = None, destinations: Optional[Dict[str, float]] = None):
+        self.sim = sim
+        self.rng = random.Random(seed)
+        self.rate = rate
+        nodes = list(sim.graph.nodes)
+        self.origins = origins or {n: 1.0 for n in nodes}
+        self.destinations = destinations or {n: 1.0 for n in nodes}
+        self.now = 0.0
+        self.events = []  # (time, seq, kind, payload)
+        self._seq = 0
+        self.plans: Dict[str, Dict[str, Any]] = {}  # driver -> points still to drive and the stops they cover
+        self.odometer = {d['id']: 0.0 for d in sim.drivers}
+        self.riders: Dict[str, Dict[str, Any]] = {}
+        self.processed = 0
+
+    def _push(self, at: float, kind: str, payload):
+        self._seq += 1
+        heapq.heappush(self.events, (at, self._seq, kind, payload))
+
+    def _draw(self, weights: Dict[str, float], exclude: str = None) -> str:
+        nodes = [n for n in weights if n != exclude]
+        return self.rng.choices(nodes, [weights[n] for n in nodes])[0]
+
+    def _edge(self, u: str, v: str) -> float:
+        ids, index, offsets, targets, weights = self.sim.graph.freeze()
+        i, j = index[u], index[v]
+        return min(weights[e] for e in range(offsets[i], offsets[i + 1]) if targets[e] == j)
+
+    def _plan(self, d):
+        # timed points along the driver's remaining stops: (time, node, odometer, stops left after it, is_stop)
+        stops = _dedup(d['stops'])
+        points, t, odo, here = [], self.now, self.odometer[d['id']], d['location']
+        for k, stop in enumerate(stops):
+            path = self.sim.graph.dijkstra(here, stop)['path']
+            for a, b in zip(path, path[1:]):
+                w = self._edge(a, b)
+                t, odo = t + w / self.SPEED, odo + w
+                points.append((t, b, odo, None, False))
+            points.append((t, stop, odo, stops[k + 1:], True))
+            here = stop
+        self._seq += 1
+        plan = self.plans[d['id']] = {'id': self._seq, 'stops': stops, 'points': points, 'next': 0}
+        self._schedule(d['id'], plan)
+        for p in d['passengers']:
+            if len(d['passengers']) > 1 and p['userId'] in self.riders:
+                self.riders[p['userId']]['pooled'] = True
+
+    def _replan_changed(self):
+        for d in self.sim.drivers:
+            plan = self.plans.get(d['id'])
+            if d['status'] != 'en-route':
+                self.plans.pop(d['id'], None)
+            elif plan is None or plan['stops'] != _dedup(d['stops']):
+                self._plan(d)
+
+    def _schedule(self, driver_id: str, plan):
+        # each plan has exactly one pending event, at its next stop; superseded plans' events are ignored
+        upcoming = next((p for p in plan['points'][plan['next']:] if p[4]), None)
+        if upcoming is not None:
+            self._push(upcoming[0], 'drive', (driver_id, plan['id']))
+
+    def _drive(self, driver_id: str, until: float):
+        # move one driver along its plan up to `until`, reporting stops and finally the last node passed
+        plan = self.plans.get(driver_id)
+        if plan is None:
+            return
+        points, last = plan['points'], None
+        while plan['next'] < len(points) and points[plan['next']][0] <= until:
+            at, node, odo, left, is_stop = points[plan['next']]
+            plan['next'] += 1
+            self.odometer[driver_id] = odo
+            if not is_stop:
+                last = node
+                continue
+            last = None
+            res = self.sim.arrive(driver_id, node)
+            plan['stops'] = left
+            for uid in res.get('boarded', []):
+                self.riders[uid].update(boarded=at, board_odometer=odo)
+            for uid in res.get('dropped', []):
+                self.riders[uid].update(dropped=at, ride_distance=odo - self.riders[uid]['board_odometer'])
+            if res.get('completed'):
+                self.sim.dispatch_waiting()
+            self._replan_changed()
+            if self.plans.get(driver_id) is not plan:
+                return
+        if last is not None:
+            self.sim.arrive(driver_id, last)  # not a stop: only the driver's location moves
+
+    def _arrival(self, n: int):
+        uid = f'rider-{n}'
+        src = self._draw(self.origins)
+        dst = self._draw(self.destinations, exclude=src)
+        for driver_id in list(self.plans):  # pooling plans from where the cars are now
+            self._drive(driver_id, self.now)
+        self.riders[uid] = {'source': src, 'destination': dst, 'arrived': self.now, 'pooled': False}
+        started = time.perf_counter()
+        self.sim.submit(uid, src, dst)
+        self.riders[uid]['submit_ms'] = (time.perf_counter() - started) * 1000
+        self._replan_changed()
+
+    def run(self, riders: int) -> Dict[str, Any]:
+        started = time.perf_counter()
+        t = 0.0
+        for n in range(riders):
+            t += self.rng.expovariate(self.rate)
+            self._push(t, 'arrival', n)
+        while self.events:
+            self.now, _, kind, payload = heapq.heappop(self.events)
+            self.processed += 1
+            if kind == 'arrival':
+                self._arrival(payload)
+            else:
+                driver_id, plan_id = payload
+                plan = self.plans.get(driver_id)
+                if plan is None or plan['id'] != plan_id:
+                    continue
+                self._drive(driver_id, self.now)
+                if self.plans.get(driver_id) is plan:
+                    self._schedule(driver_id, plan)
+        return self.summary(time.perf_counter() - started)
+
+    def summary(self, wall: float) -> Dict[str, Any]:
+        riders = list(self.riders.values())
+        served = [r for r in riders if 'dropped' in r]
+        detours = []
+        for r in served:
+            direct = self.sim.graph.dijkstra(r['source'], r['destination'])['distance']
+            if direct > 0:
+                detours.append(r['ride_distance'] / direct - 1)
+        latency = [r['submit_ms'] for r in riders]
+        waits = [r['boarded'] - r['arrived'] for r in served]
+        return {
+            'riders': len(riders),
+            'served': len(served),
+            'unserved': len(riders) - len(served),
+            'pooling_rate': round(sum(r['pooled'] for r in served) / max(1, len(served)), 4),
+            'detour_mean': round(sum(detours) / max(1, len(detours)), 4),
+            'detour_p95': round(percentile(detours, 0.95), 4),
+            'wait_mean_min': round(sum(waits) / max(1, len(waits)), 2),
+            'sim_minutes': round(self.now, 2),
+            'events': self.processed,
+            'submit_ms_mean': round(sum(latency) / max(1, len(latency)), 3),
+            'submit_ms_p50': round(percentile(latency, 0.5), 3),
+            'submit_ms_p95': round(percentile(latency, 0.95), 3),
+            'submit_ms_max': round(max(latency, default=0.0), 3),
+            'wall_s': round(wall, 3),
+            'routing_cache': self.sim.graph.cache_info(),
+        }
+
+
+def run_scenario(name: str, seed: int = 0, **overrides) -> Dict[str, Any]:
+    settings = {**SCENARIOS[name], **overrides}
+    random.seed(seed)  # driver placement inside CarpoolSimulator uses the module-level RNG
+    sim = CarpoolSimulator(fleet=settings['fleet'], graph=settings.get('graph'))
+    origins = None
+    if settings.get('hotspots'):
+        rng = random.Random(seed)
+        nodes = list(sim.graph.nodes)
+        hot = set(rng.sample(nodes, settings['hotspots']))
+        origins = {n: len(nodes) if n in hot else 1.0 for n in nodes}
+    result = EventSimulation(sim, seed=seed, rate=settings['rate'], origins=origins).run(settings['riders'])
+    sim.close()
+    return {'scenario': name, 'seed': seed, **result}
+
+
+def regressions(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    base = {(r['scenario'], r['seed']): r for r in baseline}
+    found = []
+    for r in results:
+        b = base.get((r['scenario'], r['seed']))
+        if b is None:
+            continue
+        for key in ('submit_ms_p95', 'wall_s'):
+            if r[key] > b[key] * (1 + tolerance):
+                found.append(f"{r['scenario']}: {key} {r[key]} vs baseline {b[key]}")
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Seeded carpool simulation benchmarks.')
+    parser.add_argument('scenarios', nargs='*', default=list(SCENARIOS), help=f"default: all of {', '.join(SCENARIOS)}")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results as JSON (e.g. to become the next baseline)')
+    parser.add_argument('--baseline', help='results JSON to compare against; exits 1 on a latency regression')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed slowdown vs the baseline (0.5 = 50%%)')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.scenarios:
+        result = run_scenario(name, seed=args.seed)
+        results.append(result)
+        print(json.dumps(result))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f'REGRESSION {line}', file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,113 @@
-import random
-from app.data import SAMPLE_GRAPH, initialize_drivers
-from app.graph import Graph
+import copy
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from app.data import build_graph, initialize_drivers
 from app.carpooling import find_nearest_idle_driver, find_best_pool_option
+from app.history import RideHistory, temporary_log
+from app.store import DriverStore, MemoryDriverStore, SQLiteDriverStore, ReservationConflict
 
 class CarpoolSimulator:
-    def __init__(self):
-        self.graph = Graph()
-        for node in SAMPLE_GRAPH['nodes']:
-            self.graph.add_node(node['id'], node['lat'], node['lng'], node['name'])
-        for edge in SAMPLE_GRAPH['edges']:
-            self.graph.add_edge(edge['u'], edge['v'], edge['weight'])
-        self.drivers = initialize_drivers(3, SAMPLE_GRAPH['nodes'])
+    ROUTING_BACKEND = 'dijkstra'
+    MAX_ATTEMPTS = 5  # re-plans after losing a driver reservation before giving up
+
+    def __init__(self, backend: str = None, hierarchy: str = None, store: DriverStore = None, graph: str = None,
+                 history: str = None):
+        self.graph = build_graph(graph)
+        self.graph.freeze()
+        if hierarchy:
+            self.graph.load_hierarchy(hierarchy)
+        else:
+            self.graph.select_backend(backend or self.ROUTING_BACKEND)
+        self.drivers = initialize_drivers(3, self.graph.nodes)
         self.requests = []
-        self.history = []
+        self.history = RideHistory(history)
+        # drivers are owned by the store; local copies are refreshed before each request and only changed
+        # under an atomic per-driver reservation, so concurrent requests never double-book a driver
+        self._lock = threading.RLock()
+        self.store = store or MemoryDriverStore()
+        self.store.seed(self.drivers)
+        self._by_id = {d['id']: d for d in self.drivers}
+        self._store_versions = {}
+        self._sync()
 
     def get_full_status(self):
-        return {'drivers': self.drivers, 'requests': self.requests, 'history': self.history}
+        with self._lock:
+            return {'drivers': [dict(d) for d in self.drivers], 'requests': list(self.requests),
+                    'history': self.history.recent()}
+
+    def _sync(self):
+        """Pull drivers changed by other threads or workers; returns the versions a plan is based on."""
+        with self._lock:
+            for state, version in self.store.changed_since(self._store_versions):
+                driver = self._by_id.get(state['id'])
+                if driver is not None:
+                    driver.clear()
+                    driver.update(state)
+                    self._store_versions[driver['id']] = version
+            return dict(self._store_versions)
+
+    @contextmanager
+    def _claim(self, driver, seen):
+        """Exclusive use of a driver that nobody changed since `seen`; changes are committed on exit.
+
+        If the body or the commit fails, the local copy is put back and reloaded from the store on the next sync.
+        """
+        token = self.store.reserve(driver['id'], seen[driver['id']])
+        if token is None:
+            raise ReservationConflict(f"{driver['id']} changed while planning")
+        before = copy.deepcopy(driver)
+        try:
+            yield driver
+            version = self.store.commit(token, driver)
+        except BaseException:
+            self.store.release(token)
+            with self._lock:
+                driver.clear()
+                driver.update(before)
+                self._store_versions.pop(driver['id'], None)
+            raise
+        with self._lock:
+            self._store_versions[driver['id']] = version
 
     def submit_request(self, user_id, source, dest):
-        new_req = {'id': f'R-{random.randint(1000,9999)}', 'userId': user_id, 'source': source, 'destination': dest}
+        for node in (source, dest):
+            if node not in self.graph.nodes:
+                return {'success': False, 'message': f'Unknown location: {node}'}
+        if self.graph.dijkstra(source, dest)['distance'] == float('inf'):
+            return {'success': False, 'message': f'No route from {source} to {dest}'}
+        new_req = {'id': f'R-{uuid.uuid4().hex[:12]}', 'userId': user_id, 'source': source, 'destination': dest}
+        for _ in range(self.MAX_ATTEMPTS):
+            try:
+                return self._submit(new_req)
+            except ReservationConflict:
+                continue  # another request took the driver first; plan again against fresh state
+        with self._lock:
+            self.requests.append(new_req)
+        return {'success': False, 'message': 'No available drivers.'}
+
+    def _submit(self, new_req):
+        seen = self._sync()
+        user_id, source, dest = new_req['userId'], new_req['source'], new_req['destination']
         idle = find_nearest_idle_driver(source, self.drivers, self.graph)
         best_driver, dist = idle['best_driver'], idle['min_pickup_dist']
         if not best_driver:
-            self.requests.append(new_req)
+            with self._lock:
+                self.requests.append(new_req)
             return {'success': False, 'message': 'No available drivers.'}
 
         route = self.graph.get_multi_segment_route([best_driver['location'], source, dest])
-        best_driver.update({'status': 'en-route', 'passengers': [new_req], 'current_route_stops': [source, dest]})
-        self.history.append({'driver': best_driver['id'], 'request': new_req, 'distance': route['distance']})
+        with self._claim(best_driver, seen):
+            best_driver.update({'status': 'en-route', 'passengers': [new_req], 'current_route_stops': [source, dest]})
+        with self._lock:
+            self.history.append({'type': 'Assigned', 'driver': best_driver['id'], 'request': new_req, 'distance': route['distance']})
         return {'success': True, 'message': f"Assigned {best_driver['id']} to {user_id}!", 'route': route}
 
-simulator = CarpoolSimulator()
+# CARPOOL_CH_ARTIFACT is a hierarchy from `python -m app.contraction`; CARPOOL_STATE_DB shares driver state between
+# worker processes through SQLite; CARPOOL_GRAPH picks the road graph; CARPOOL_HISTORY_DB keeps the full ride history on disk
+# (in a temporary file when unset)
+simulator = CarpoolSimulator(hierarchy=os.environ.get('CARPOOL_CH_ARTIFACT'),
+                             store=SQLiteDriverStore(os.environ['CARPOOL_STATE_DB'])
+                             if os.environ.get('CARPOOL_STATE_DB') else None, graph=os.environ.get('CARPOOL_GRAPH'),
+                             history=os.environ.get('CARPOOL_HISTORY_DB') or temporary_log())
@@ -0,0 +1,146 @@
+"""Driver state stores with atomic reservation, so concurrent requests never double-book a driver."""
+import copy
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Tuple
+
+Driver = Dict[str, Any]
+
+
+class ReservationConflict(Exception):
+    """The driver changed (or is being changed) since it was read; re-read and plan again."""
+
+
+class DriverStore(ABC):
+    # a change reserves the driver at the version it was read at (failing if anyone else changed or is changing
+    # it), mutates the local copy and commits it back, which bumps the version
+    @abstractmethod
+    def seed(self, drivers: List[Driver]):
+        """Insert drivers that the store does not know yet (the first process to start wins)."""
+
+    @abstractmethod
+    def changed_since(self, known: Dict[str, int]) -> List[Tuple[Driver, int]]:
+        """(driver, version) for every driver whose version differs from `known`."""
+
+    @abstractmethod
+    def reserve(self, driver_id: str, version: int):
+        """Token for exclusive use of the driver, or None if it is not at `version` or already reserved."""
+
+    @abstractmethod
+    def commit(self, token, driver: Driver) -> int:
+        """Store the new driver state, end the reservation and return the new version."""
+
+    @abstractmethod
+    def release(self, token):
+        """End a reservation without changing the driver."""
+
+
+class LocalConnection:
+    """One SQLite connection per thread on `path`; WAL lets readers proceed while another worker writes."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def __call__(self) -> sqlite3.Connection:
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+
+class MemoryDriverStore(DriverStore):
+    def __init__(self):
+        self._drivers: Dict[str, Driver] = {}
+        self._versions: Dict[str, int] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    def seed(self, drivers: List[Driver]):
+        with self._guard:
+            for d in drivers:
+                if d['id'] not in self._drivers:
+                    self._drivers[d['id']] = copy.deepcopy(d)
+                    self._versions[d['id']] = 1
+                    self._locks[d['id']] = threading.Lock()
+
+    def changed_since(self, known: Dict[str, int]) -> List[Tuple[Driver, int]]:
+        with self._guard:
+            return [(copy.deepcopy(self._drivers[i]), v) for i, v in self._versions.items() if known.get(i) != v]
+
+    def reserve(self, driver_id: str, version: int):
+        lock = self._locks[driver_id]
+        if not lock.acquire(blocking=False):
+            return None
+        if self._versions[driver_id] != version:
+            lock.release()
+            return None
+        return driver_id
+
+    def commit(self, token, driver: Driver) -> int:
+        with self._guard:
+            self._drivers[token] = copy.deepcopy(driver)
+            self._versions[token] += 1
+            version = self._versions[token]
+        self._locks[token].release()
+        return version
+
+    def release(self, token):
+        self._locks[token].release()
+
+
+class SQLiteDriverStore(DriverStore):
+    LEASE_SECONDS = 5.0  # a reservation left behind by a crashed worker expires after this long
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connect = LocalConnection(path)
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS drivers ('
+                       'id TEXT PRIMARY KEY, state TEXT NOT NULL, version INTEGER NOT NULL, '
+                       'lease TEXT, lease_until REAL)')
+
+    def seed(self, drivers: List[Driver]):
+        db = self._connect()
+        db.executemany('INSERT OR IGNORE INTO drivers (id, state, version) VALUES (?, ?, 1)',
+                       [(d['id'], json.dumps(d)) for d in drivers])
+
+    def changed_since(self, known: Dict[str, int]) -> List[Tuple[Driver, int]]:
+        rows = self._connect().execute('SELECT id, state, version FROM drivers').fetchall()
+        return [(json.loads(state), version) for i, state, version in rows if known.get(i) != version]
+
+    def reserve(self, driver_id: str, version: int):
+        token, now = uuid.uuid4().hex, time.time()
+        cur = self._connect().execute(
+            'UPDATE drivers SET lease = ?, lease_until = ? '
+            'WHERE id = ? AND version = ? AND (lease IS NULL OR lease_until < ?)',
+            (token, now + self.LEASE_SECONDS, driver_id, version, now))
+        return (driver_id, token) if cur.rowcount == 1 else None
+
+    def commit(self, token, driver: Driver) -> int:
+        driver_id, lease = token
+        db = self._connect()
+        db.execute('BEGIN IMMEDIATE')  # read back the version we wrote, not one another worker wrote after us
+        try:
+            cur = db.execute('UPDATE drivers SET state = ?, version = version + 1, lease = NULL, lease_until = NULL '
+                             'WHERE id = ? AND lease = ?', (json.dumps(driver), driver_id, lease))
+            if cur.rowcount != 1:
+                raise ReservationConflict(f'Reservation on {driver_id} expired before commit')
+            version = db.execute('SELECT version FROM drivers WHERE id = ?', (driver_id,)).fetchone()[0]
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return version
+
+    def release(self, token):
+        driver_id, lease = token
+        self._connect().execute('UPDATE drivers SET lease = NULL, lease_until = NULL WHERE id = ? AND lease = ?',
+                                (driver_id, lease))
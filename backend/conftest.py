@@ -0,0 +1 @@
+# makes `app` importable when pytest is run from backend/ (tests import it as the package)
@@ -0,0 +1,43 @@
+import itertools
+import random
+
+import pytest
+
+from app.engine import min_cost_assignment
+
+INF = float('inf')
+
+
+def brute_force(cost):
+    # best (number of finite pairs, total cost) over every way of matching rows to distinct columns
+    rows, cols = len(cost), len(cost[0])
+    best = (0, 0.0)
+    for k in range(min(rows, cols), 0, -1):
+        for chosen in itertools.combinations(range(rows), k):
+            for perm in itertools.permutations(range(cols), k):
+                pairs = list(zip(chosen, perm))
+                if all(cost[r][c] < INF for r, c in pairs):
+                    total = sum(cost[r][c] for r, c in pairs)
+                    if best[0] < k or total < best[1]:
+                        best = (k, total)
+        if best[0]:
+            return best
+    return best
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_matches_brute_force(seed):
+    rng = random.Random(seed)
+    rows, cols = rng.randint(1, 5), rng.randint(1, 5)
+    cost = [[INF if rng.random() < 0.2 else rng.randint(0, 20) for _ in range(cols)] for _ in range(rows)]
+    pairs = min_cost_assignment(cost)
+
+    assert len({r for r, _ in pairs}) == len(pairs) == len({c for _, c in pairs})
+    assert all(cost[r][c] < INF for r, c in pairs)
+    assert (len(pairs), sum(cost[r][c] for r, c in pairs)) == brute_force(cost)
+
+
+def test_empty_and_unreachable():
+    assert min_cost_assignment([]) == []
+    assert min_cost_assignment([[INF, INF]]) == []
+    assert min_cost_assignment([[3.0], [1.0]]) == [(1, 0)]
@@ -0,0 +1,25 @@
+from app import app as server
+from app import engine as standalone
+
+
+def test_batch_riders_pair_with_the_waiting_list_first():
+    sim = standalone.CarpoolSimulator(fleet=1)
+    waiting = sim._new_request('u0', 'A', 'C')
+    sim._enqueue(waiting)
+    [res] = sim.submit_batch([{'userId': 'u1', 'source': 'A', 'destination': 'C'}])
+
+    assert res['success'] and 'pooled with u0' in res['message']
+    assert sim.requests == []
+    assert [p['userId'] for p in sim.drivers[0]['passengers']] == ['u1', 'u0']
+
+
+def test_malformed_batches_are_rejected_without_a_server_error(monkeypatch):
+    monkeypatch.setattr(server, 'sim', standalone.CarpoolSimulator())
+    client = server.app.test_client()
+    res = client.post('/submit-requests', json={'requests': ['A', {'userId': 'u1', 'source': 'A', 'destination': 'C'}]})
+    assert res.status_code == 200
+    bad, ok = res.get_json()['results']
+    assert not bad['success'] and ok['success']
+
+    for body in ({'requests': 'A'}, ['A'], {'requests': None}):
+        assert client.post('/submit-requests', json=body).status_code == 400
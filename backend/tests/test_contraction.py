@@ -0,0 +1,79 @@
+import itertools
+import os
+import subprocess
+import sys
+
+import pytest
+
+from app import engine as standalone
+from app.contraction import ContractionHierarchy, main
+from app.data import build_graph
+from app.loaders import random_geometric_city
+
+
+def graphs():
+    yield 'sample', build_graph()
+    yield 'standalone', standalone.build_graph()
+    yield 'rgg', random_geometric_city(standalone.Graph(), 120, seed=3)
+
+
+def assert_valid_path(graph, result, source, target):
+    ids, index, offsets, targets, weights = graph.freeze()
+    path = result['path']
+    assert path[0] == source and path[-1] == target
+    length = 0.0
+    for a, b in zip(path, path[1:]):
+        i, j = index[a], index[b]
+        length += min(weights[e] for e in range(offsets[i], offsets[i + 1]) if targets[e] == j)
+    assert length == pytest.approx(result['distance'])
+
+
+@pytest.mark.parametrize('name,graph', list(graphs()))
+def test_queries_match_dijkstra(name, graph):
+    ch = ContractionHierarchy.build(graph)
+    ids = graph.freeze()[0]
+    for source, target in itertools.product(ids[:25], repeat=2):
+        expected = graph.dijkstra(source, target)['distance']
+        result = ch.query(source, target)
+        assert result['distance'] == pytest.approx(expected)
+        if expected < float('inf'):
+            assert_valid_path(graph, result, source, target)
+
+
+def test_save_and_load_round_trip(tmp_path):
+    graph = build_graph()
+    ch = ContractionHierarchy.build(graph)
+    ch.save(tmp_path / 'sample.ch')
+    loaded = ContractionHierarchy.load(tmp_path / 'sample.ch')
+    assert loaded.fingerprint == ch.fingerprint
+    assert loaded.query('A', 'F') == ch.query('A', 'F')
+
+
+def test_cli_artifacts_load_into_their_servers(tmp_path, monkeypatch):
+    monkeypatch.delenv('CARPOOL_GRAPH', raising=False)
+    main([str(tmp_path / 'package.ch')])
+    main([str(tmp_path / 'standalone.ch'), '--standalone'])
+
+    graph = build_graph()
+    graph.load_hierarchy(str(tmp_path / 'package.ch'))
+    assert graph.backend == 'ch'
+    sim = standalone.CarpoolSimulator(hierarchy=str(tmp_path / 'standalone.ch'))
+    assert sim.graph.backend == 'ch'
+    # the two sample graphs differ, so each artifact is refused by the other server
+    with pytest.raises(ValueError):
+        standalone.CarpoolSimulator(hierarchy=str(tmp_path / 'package.ch'))
+
+
+def test_servers_pick_up_the_artifact_without_side_effects(tmp_path):
+    # fresh interpreters: both servers read their environment once, at import
+    env = dict(os.environ, CARPOOL_STATE_DB=str(tmp_path / 'state.db'), PYTHONPATH=os.getcwd())
+    env.pop('CARPOOL_GRAPH', None)
+    subprocess.run([sys.executable, '-m', 'app.contraction', str(tmp_path / 'standalone.ch'), '--standalone'],
+                   env=env, check=True, capture_output=True)
+    assert not (tmp_path / 'state.db').exists()
+
+    subprocess.run([sys.executable, '-m', 'app.contraction', str(tmp_path / 'package.ch')], env=env, check=True, capture_output=True)
+    env['CARPOOL_CH_ARTIFACT'] = str(tmp_path / 'package.ch')
+    out = subprocess.run([sys.executable, '-c', 'from app.simulator import simulator; print(simulator.graph.backend)'],
+                         env=env, check=True, capture_output=True, text=True).stdout
+    assert out.split() == ['ch']
@@ -0,0 +1,66 @@
+import os
+import random
+
+import pytest
+
+from app import engine as standalone
+from app.history import RideHistory
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def history(request, tmp_path):
+    return RideHistory(str(tmp_path / 'history.db') if request.param == 'sqlite' else None)
+
+
+def test_riders_joining_a_ride_do_not_count_as_new_rides(history):
+    history.append({'type': 'Assigned', 'driver': 'D1', 'riders': ['a'], 'distance': 5.0})
+    history.append({'type': 'Pooled', 'driver': 'D1', 'riders': ['a', 'b'], 'distance': 7.0, 'added': 2.0, 'newlyPooled': True})
+    history.append({'type': 'Pooled', 'driver': 'D1', 'riders': ['a', 'b', 'c'], 'distance': 8.0, 'added': 1.0, 'newlyPooled': False})
+    history.append({'type': 'Completed', 'driver': 'D1', 'riders': [], 'distance': 0})
+    history.append({'type': 'Pooled', 'driver': 'D2', 'riders': ['d', 'e'], 'distance': 4.0})  # a group ride
+    history.append({'type': 'Assigned', 'driver': 'D2', 'riders': ['f'], 'distance': 3.0})
+
+    stats = history.stats()
+    assert stats['drivers']['D1'] == {'rides': 1, 'pooled': 1, 'completed': 1, 'distance': 8.0}
+    assert (stats['rides'], stats['pooled'], stats['distance'], stats['pooledRatio']) == (3, 2, 15.0, pytest.approx(2 / 3))
+
+
+def test_a_shared_ride_is_counted_once_in_the_simulator():
+    random.seed(0)
+    sim = standalone.CarpoolSimulator(fleet=1)
+    for uid, src, dst in [('u1', 'A', 'F'), ('u2', 'C', 'F'), ('u3', 'A', 'B')]:
+        assert sim.submit(uid, src, dst)['success']
+    assert len(sim.drivers[0]['passengers']) == 3
+
+    stats = sim.history.stats()
+    assert (stats['rides'], stats['pooled']) == (1, 1)
+    # the car has not moved, so the added distances sum to the plan it ends up with
+    assert stats['distance'] == pytest.approx(sim.history.recent()[-1]['distance'])
+
+    sim.complete('Driver-1')
+    sim.submit('u4', 'A', 'C')
+    stats = sim.history.stats()
+    assert (stats['rides'], stats['pooled'], stats['completed']) == (2, 1, 1)
+
+
+@pytest.mark.parametrize('path', [None, 'history.db'])
+def test_paging_stops_at_the_oldest_entry_left(tmp_path, path):
+    history = RideHistory(path and str(tmp_path / path), recent=5)
+    for k in range(12):
+        history.append({'type': 'Completed', 'driver': f'D{k}', 'riders': []})
+    pages, before = [], None
+    while True:
+        page = history.page(before, limit=5)
+        pages.append([e['seq'] for e in page['entries']])
+        before = page['next']
+        if before is None:
+            break
+    # the log keeps everything; without one only the last `recent` entries exist, and no page points past them
+    assert pages == ([[12, 11, 10, 9, 8], [7, 6, 5, 4, 3], [2, 1]] if path else [[12, 11, 10, 9, 8]])
+
+
+def test_servers_log_history_to_a_file_by_default():
+    from app import app as server
+    from app import simulator as package
+    for history in (server.sim.history, package.simulator.history):
+        assert history.path and os.path.exists(history.path)
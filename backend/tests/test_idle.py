@@ -0,0 +1,25 @@
+import random
+
+import pytest
+
+from app import engine as standalone
+
+
+def test_nearest_idle_driver_by_road_distance():
+    random.seed(4)
+    sim = standalone.CarpoolSimulator(graph='rgg:150', fleet=20)
+    rng = random.Random(4)
+    nodes = list(sim.graph.nodes)
+    for k in range(30):
+        src, dst = rng.choice(nodes), rng.choice(nodes)
+        if sim._invalid('u', src, dst): continue
+        req = sim._new_request(f'u{k}', src, dst)
+        idle = [d for d in sim.drivers if d['status'] == 'idle']
+        assert sorted(d['id'] for d in sim.idle_index.values()) == sorted(d['id'] for d in idle)
+        found = sim._find_idle_driver(req)
+        if not idle:
+            assert found is None
+            break
+        nearest = min(sim.graph.dijkstra(d['location'], src)['distance'] for d in idle)
+        assert sim.graph.dijkstra(found['driver']['location'], src)['distance'] == pytest.approx(nearest)
+        sim._submit(req)
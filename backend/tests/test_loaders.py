@@ -0,0 +1,106 @@
+import itertools
+import json
+import pickle
+
+import pytest
+
+from app import engine as standalone
+from app import simulator as package
+from app.data import build_graph
+from app.graph import Graph
+from app.loaders import grid_city, load_binary, load_graph, random_geometric_city, save_binary
+
+
+@pytest.fixture
+def roads(tmp_path):
+    (tmp_path / 'roads.txt').write_text('# u v km\nA B 1.0\nB C 2.0\n')
+    (tmp_path / 'roads.csv').write_text('u,v,weight\nA,B,1.0\nB,C,2.0\n')
+    (tmp_path / 'nodes.csv').write_text('id,lat,lng,name\nA,40.70,-74.00,Alpha\nB,40.71,-74.00,\n')
+    return tmp_path
+
+
+@pytest.mark.parametrize('edges', ['roads.txt', 'roads.csv'])
+def test_edges_without_coordinates_are_refused(roads, edges):
+    with pytest.raises(ValueError, match='no node has coordinates'):
+        build_graph(str(roads / edges))
+    with pytest.raises(ValueError, match='no node has coordinates'):
+        standalone.build_graph(str(roads / edges))
+
+
+@pytest.mark.parametrize('edges', ['roads.txt', 'roads.csv'])
+def test_edges_with_a_nodes_file_serve_requests(roads, edges):
+    spec = f"{roads / edges},{roads / 'nodes.csv'}"
+    sim = standalone.CarpoolSimulator(graph=spec)
+    assert {d['location'] for d in sim.drivers} <= {'A', 'B'} and len(sim.drivers) == sim.FLEET_SIZE
+    assert sim.submit('u1', 'A', 'B')['success']
+    assert not sim.submit('u2', 'A', 'C')['success']  # C has no coordinates
+    assert {d['location'] for d in package.CarpoolSimulator(graph=spec).drivers} <= {'A', 'B'}
+
+
+def components(graph):
+    ids, _, offsets, targets, _ = graph.freeze()
+    seen, count = set(), 0
+    for start in range(len(ids)):
+        if start in seen:
+            continue
+        count, stack = count + 1, [start]
+        seen.add(start)
+        while stack:
+            u = stack.pop()
+            for e in range(offsets[u], offsets[u + 1]):
+                if targets[e] not in seen:
+                    seen.add(targets[e])
+                    stack.append(targets[e])
+    return count
+
+
+@pytest.mark.parametrize('graph_class', [Graph, standalone.Graph], ids=['package', 'standalone'])
+def test_synthetic_cities(graph_class):
+    grid = grid_city(graph_class(), 4, 6)
+    ids, _, _, targets, _ = grid.freeze()
+    assert len(ids) == 24 and len(targets) == 2 * (4 * 5 + 3 * 6) and components(grid) == 1
+    assert grid.dijkstra('0-0', '3-5')['distance'] > 0
+
+    city = random_geometric_city(graph_class(), 200, seed=2)
+    assert 0 < len(city.freeze()[0]) <= 200 and components(city) == 1  # only the largest part is kept
+    assert city.freeze()[0] == random_geometric_city(graph_class(), 200, seed=2).freeze()[0]
+
+
+@pytest.mark.parametrize('graph_class', [Graph, standalone.Graph], ids=['package', 'standalone'])
+def test_binary_round_trip(tmp_path, graph_class):
+    original = random_geometric_city(graph_class(), 120, seed=5)
+    save_binary(original, str(tmp_path / 'city.cgraph'))
+    loaded = load_binary(str(tmp_path / 'city.cgraph'), graph_class())
+    assert loaded.source == str(tmp_path / 'city.cgraph')
+    ids = original.freeze()[0]
+    assert list(loaded.freeze()[0]) == list(ids)
+    assert loaded.nodes[ids[0]]['lat'] == original.nodes[ids[0]]['lat']
+    for source, target in itertools.product(ids[::11], ids[::17]):
+        expected = original.dijkstra(source, target)['distance']
+        assert loaded.dijkstra(source, target)['distance'] == pytest.approx(expected)
+        assert loaded.dijkstra(source, target, 'astar')['distance'] == pytest.approx(expected)
+
+
+def test_a_mapped_graph_pickles_as_its_path(tmp_path):
+    path = str(tmp_path / 'grid.cgraph')
+    save_binary(load_graph('grid:5x5', standalone.Graph()), path)
+    graph = standalone.build_graph(path)
+    assert graph.__getstate__()['source'] == path
+    copy = pickle.loads(pickle.dumps(graph))
+    assert copy.source == path and copy.dijkstra('0-0', '4-4') == graph.dijkstra('0-0', '4-4')
+
+    graph.add_edge('0-0', '4-4', 0.01)  # edited in memory: the file no longer describes it
+    assert graph.source is None and 'source' not in graph.__getstate__()
+
+
+def test_geojson_roads(tmp_path):
+    (tmp_path / 'roads.geojson').write_text(json.dumps({'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'LineString', 'coordinates': [[-74.0, 40.7], [-74.0, 40.71], [-73.99, 40.71]]}},
+        {'type': 'Feature', 'properties': {}, 'geometry': {'type': 'MultiLineString', 'coordinates': [[[-73.99, 40.71], [-73.99, 40.72]]]}},
+        {'type': 'Feature', 'properties': {'name': 'Station'}, 'geometry': {'type': 'Point', 'coordinates': [-73.99, 40.72]}},
+    ]}))
+    for graph in (build_graph(str(tmp_path / 'roads.geojson')), standalone.build_graph(str(tmp_path / 'roads.geojson'))):
+        assert len(graph.nodes) == 4  # the shared vertex joins the two roads
+        assert graph.nodes['40.720000,-73.990000']['name'] == 'Station'
+        # 0.01 degrees of latitude is about 1.11 km; the east-west leg is shorter by cos(40.71)
+        assert graph.dijkstra('40.700000,-74.000000', '40.720000,-73.990000')['distance'] == pytest.approx(1.11 * 2 + 0.84, abs=0.01)
@@ -0,0 +1,47 @@
+import random
+import time
+
+from app import engine as standalone
+
+
+def fleet(sim, count, seed):
+    rng = random.Random(seed)
+    nodes = list(sim.graph.nodes)
+    return nodes, [{'id': f'D{i}', 'location': rng.choice(nodes), 'status': 'en-route', 'stops': [],
+                    'passengers': [{'id': f'p{i}', 'source': rng.choice(nodes), 'destination': rng.choice(nodes)}]}
+                   for i in range(count)]
+
+
+def best(sim, req):
+    pool = sim._find_best_pool(req)
+    return pool and (pool['driver']['id'], pool['route'], pool['stops'])
+
+
+def test_worker_pool_matches_serial_and_falls_back_on_timeout():
+    parallel, serial = standalone.CarpoolSimulator(workers=2), standalone.CarpoolSimulator(workers=0)
+    parallel.PARALLEL_MIN_DRIVERS = 2
+    nodes, drivers = fleet(parallel, 24, seed=5)
+    parallel.drivers = serial.drivers = drivers
+    rng = random.Random(6)
+    try:
+        for _ in range(10):
+            req = {'id': 'x', 'source': rng.choice(nodes), 'destination': rng.choice(nodes)}
+            assert best(parallel, req) == best(serial, req)
+        assert parallel._executor is not None
+
+        for _ in range(parallel.pool_workers):  # both workers are busy for longer than the timeout
+            parallel._executor.submit(time.sleep, 1.0)
+        parallel.POOL_TIMEOUT = 0.1
+        assert best(parallel, req) == best(serial, req)
+        assert parallel._executor is None
+    finally:
+        parallel.close()
+
+
+def test_matrix_backend_evaluates_serially():
+    # workers would have to rebuild the all-pairs matrix before their first answer
+    sim = standalone.CarpoolSimulator(workers=2, backend='matrix')
+    sim.PARALLEL_MIN_DRIVERS = 2
+    nodes, sim.drivers = fleet(sim, 8, seed=1)
+    sim._find_best_pool({'id': 'x', 'source': nodes[0], 'destination': nodes[-1]})
+    assert sim._executor is None
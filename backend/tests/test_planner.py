@@ -0,0 +1,90 @@
+import itertools
+import random
+
+import pytest
+
+from app import engine as standalone
+
+
+@pytest.fixture(scope='module')
+def sim():
+    return standalone.CarpoolSimulator(graph='rgg:80', fleet=1)
+
+
+def leg(sim, a, b):
+    return sim.graph.dijkstra(a, b)['distance']
+
+
+def length(sim, seq):
+    return sum(leg(sim, a, b) for a, b in zip(seq, seq[1:]))
+
+
+def rider(rng, nodes, k, onboard=False):
+    return {'id': f'R{k}', 'userId': f'u{k}', 'source': rng.choice(nodes), 'destination': rng.choice(nodes), 'onboard': onboard}
+
+
+def permutation_search(sim, start, passengers):
+    # the search the planners replaced: every pickup/drop order, keeping those that drop only picked-up riders
+    pts = [(p['destination'], k, 'D') for k, p in enumerate(passengers)]
+    pts += [(p['source'], k, 'P') for k, p in enumerate(passengers) if not p.get('onboard')]
+    best = float('inf')
+    for perm in itertools.permutations(pts):
+        picked = {k for k, p in enumerate(passengers) if p.get('onboard')}
+        valid = True
+        for _, k, phase in perm:
+            if phase == 'P': picked.add(k)
+            elif k not in picked: valid = False; break
+        if valid: best = min(best, length(sim, [start] + [node for node, _, _ in perm]))
+    return best
+
+
+def slot_search(sim, seq, src, dst):
+    # every (pickup, drop) slot in a fixed stop order
+    return min(length(sim, seq[:i] + [src] + seq[i:j] + [dst] + seq[j:])
+               for i in range(1, len(seq) + 1) for j in range(i, len(seq) + 1))
+
+
+def driver(rng, nodes, riders):
+    passengers = [rider(rng, nodes, k, onboard=rng.random() < 0.5) for k in range(riders)]
+    return {'id': 'D', 'location': rng.choice(nodes), 'status': 'en-route', 'passengers': passengers, 'stops': []}
+
+
+@pytest.mark.parametrize('seed', range(25))
+def test_exact_plan_matches_the_permutation_search(sim, seed):
+    rng = random.Random(seed)
+    nodes = list(sim.graph.nodes)
+    d, req = driver(rng, nodes, rng.randint(0, 3)), rider(rng, nodes, 9)
+    passengers = d['passengers'] + [req]
+
+    stops, cost = sim._plan_exact(d['location'], passengers)
+    assert cost == pytest.approx(permutation_search(sim, d['location'], passengers))
+    assert cost == pytest.approx(length(sim, [d['location']] + stops))
+    assert sorted(stops) == sorted([p['destination'] for p in passengers] + [p['source'] for p in passengers if not p['onboard']])
+
+    # and the pooling decision is the old one: the cheapest order, if it is within the detour limit
+    base = length(sim, [d['location']] + sim._remaining_stops(d))
+    option = sim._evaluate_pool(d, req)
+    within = cost - base <= sim.MAX_DETOUR * max(base, 0.1) * (1 + 1e-9)
+    assert (option is not None) == within
+    if option: assert option['distance'] == pytest.approx(cost)
+
+
+@pytest.mark.parametrize('seed', range(25))
+def test_insertion_plan_is_the_cheapest_slot_pair(sim, seed):
+    # vans with more seats than EXACT_PLAN_MAX_RIDERS are planned by insertion alone
+    rng = random.Random(seed)
+    nodes = list(sim.graph.nodes)
+    d, req = driver(rng, nodes, rng.randint(sim.EXACT_PLAN_MAX_RIDERS, 7)), rider(rng, nodes, 9)
+    seq = [d['location']] + sim._remaining_stops(d)
+
+    stops, cost = sim._plan_stops(d, req)
+    assert cost == pytest.approx(slot_search(sim, seq, req['source'], req['destination']))
+    assert cost == pytest.approx(length(sim, [d['location']] + stops))
+    # the new rider is slotted into the existing stop order, which is kept
+    src, dst = req['source'], req['destination']
+    assert any(stops == seq[1:i] + [src] + seq[i:j] + [dst] + seq[j:]
+               for i in range(1, len(seq) + 1) for j in range(i, len(seq) + 1))
+
+    assert sim._plan_insertion(d, req, cost * 0.999) is None
+    option = sim._evaluate_pool(d, req)
+    assert option is None or option['distance'] == pytest.approx(cost)
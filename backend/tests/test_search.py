@@ -0,0 +1,38 @@
+import itertools
+
+import pytest
+
+from app import engine as standalone
+from app.graph import Graph
+from app.loaders import random_geometric_city
+
+
+def city(graph_class):
+    graph = random_geometric_city(graph_class(), 150, seed=7)
+    graph.add_node('island', 40.75, -73.95)  # no roads: unreachable from everywhere else
+    graph.freeze()
+    return graph
+
+
+def path_length(graph, path):
+    ids, index, offsets, targets, weights = graph.freeze()
+    length = 0.0
+    for a, b in zip(path, path[1:]):
+        i, j = index[a], index[b]
+        length += min(weights[e] for e in range(offsets[i], offsets[i + 1]) if targets[e] == j)
+    return length
+
+
+@pytest.mark.parametrize('graph_class', [Graph, standalone.Graph], ids=['package', 'standalone'])
+@pytest.mark.parametrize('method', ['astar', 'bidirectional'])
+def test_point_to_point_searches_match_dijkstra(graph_class, method):
+    graph = city(graph_class)
+    ids = graph.freeze()[0]
+    pairs = list(itertools.product(ids[::9], ids[::13])) + [(ids[3], ids[3]), (ids[0], 'island'), ('island', 'island')]
+    for source, target in pairs:
+        expected = graph.dijkstra(source, target)
+        result = graph.dijkstra(source, target, method)
+        assert result['distance'] == pytest.approx(expected['distance']), (source, target)
+        if expected['distance'] < float('inf'):
+            assert result['path'][0] == source and result['path'][-1] == target
+            assert path_length(graph, result['path']) == pytest.approx(result['distance'])
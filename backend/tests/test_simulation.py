@@ -0,0 +1,11 @@
+from app.simulation import run_scenario
+
+LATENCY = ('submit_ms_mean', 'submit_ms_p50', 'submit_ms_p95', 'submit_ms_max', 'wall_s')
+
+
+def test_a_seeded_scenario_is_reproducible():
+    first, second = run_scenario('smoke', riders=50), run_scenario('smoke', riders=50)
+    for key in LATENCY:
+        del first[key], second[key]
+    assert first == second
+    assert first['served'] + first['unserved'] == 50
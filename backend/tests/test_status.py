@@ -0,0 +1,43 @@
+from app.engine import CarpoolSimulator
+
+
+def test_deltas_list_removed_requests():
+    sim = CarpoolSimulator(fleet=1)
+    req = sim._new_request('waiting', 'A', 'C')
+    sim._enqueue(req)
+    v = sim.version
+    sim._dequeue(req)
+    delta = sim.status(since=v)
+    assert delta['requests'] == {'added': [], 'removed': [req['id']]}
+    assert 'reset' not in delta
+
+
+def test_clients_behind_the_retained_removals_get_a_reset():
+    sim = CarpoolSimulator(fleet=1)
+    sim.REMOVALS_KEPT = 3
+    start = sim.version
+    for i in range(5):
+        req = sim._new_request(f'u{i}', 'B', 'C')
+        sim._enqueue(req)
+        sim._dequeue(req)
+    assert len(sim._removed_requests) == 3
+    recent = sim.status(since=sim.version - 2)
+    assert 'reset' not in recent and len(recent['requests']['removed']) == 1
+    behind = sim.status(since=start)
+    assert behind['reset'] and len(behind['drivers']) == 1 and behind['requests']['removed'] == []
+
+
+def test_request_ids_are_unique():
+    sim = CarpoolSimulator(fleet=1)
+    ids = {sim._new_request('u', 'A', 'B')['id'] for _ in range(5000)}
+    assert len(ids) == 5000
+
+
+def test_waiting_requests_are_tracked_by_id_not_object():
+    # requests round-trip through JSON (stores, workers), so a copy must find the same waiting-list entry
+    sim = CarpoolSimulator(fleet=1)
+    req = sim._new_request('waiting', 'A', 'C')
+    sim._enqueue(req)
+    assert sim._dequeue(dict(req))
+    assert sim.requests == [] and len(sim.request_index) == 0 and sim._trips == {}
+    assert not sim._dequeue(req)
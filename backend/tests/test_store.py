@@ -0,0 +1,93 @@
+import pytest
+
+from app import engine as standalone
+from app import simulator as package
+from app.store import DriverStore, MemoryDriverStore, ReservationConflict, SQLiteDriverStore
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    store = MemoryDriverStore() if request.param == 'memory' else SQLiteDriverStore(str(tmp_path / 'state.db'))
+    store.seed([{'id': 'D1', 'status': 'idle'}, {'id': 'D2', 'status': 'idle'}])
+    return store
+
+
+def versions(store):
+    return {d['id']: v for d, v in store.changed_since({})}
+
+
+def test_reserve_is_exclusive_and_commit_bumps_the_version(store):
+    token = store.reserve('D1', 1)
+    assert token is not None
+    assert store.reserve('D1', 1) is None  # held
+    assert store.commit(token, {'id': 'D1', 'status': 'en-route'}) == 2
+    assert store.reserve('D1', 1) is None  # stale version
+    assert [d for d, _ in store.changed_since({'D1': 1, 'D2': 1})] == [{'id': 'D1', 'status': 'en-route'}]
+
+
+def test_release_leaves_the_driver_unchanged(store):
+    store.release(store.reserve('D2', 1))
+    assert versions(store) == {'D1': 1, 'D2': 1}
+    assert store.reserve('D2', 1) is not None
+
+
+def test_sqlite_stores_share_state_and_expire_leases(tmp_path, monkeypatch):
+    path = str(tmp_path / 'state.db')
+    a, b = SQLiteDriverStore(path), SQLiteDriverStore(path)
+    a.seed([{'id': 'D1', 'status': 'idle'}])
+    token = a.reserve('D1', 1)
+    assert b.reserve('D1', 1) is None
+    monkeypatch.setattr(SQLiteDriverStore, 'LEASE_SECONDS', -1.0)  # b's lease is expired as soon as it is taken
+    a.release(token)
+    stale = b.reserve('D1', 1)
+    assert a.reserve('D1', 1) is not None  # takes over the expired lease
+    with pytest.raises(ReservationConflict):
+        b.commit(stale, {'id': 'D1', 'status': 'en-route'})
+
+
+def fail_commits(monkeypatch, store_class):
+    def commit(self, token, driver):
+        raise ReservationConflict('lease expired')
+    monkeypatch.setattr(store_class, 'commit', commit)
+
+
+def test_failed_commit_leaves_no_trace_in_the_standalone_simulator(monkeypatch):
+    sim = standalone.CarpoolSimulator(fleet=1)
+    [driver] = sim.drivers
+    before = dict(driver)
+    fail_commits(monkeypatch, MemoryDriverStore)
+    res = sim.submit('u1', 'A', 'C')
+
+    assert not res['success']
+    assert len(sim.history) == 0
+    assert driver == before and sim.idle_index.values() == [driver]
+    assert [r['userId'] for r in sim.requests] == ['u1']
+
+
+def test_failed_commit_puts_back_the_pooled_waiting_rider(monkeypatch):
+    sim = standalone.CarpoolSimulator(fleet=1)
+    waiting = sim._new_request('u0', 'A', 'C')
+    sim._enqueue(waiting)
+    fail_commits(monkeypatch, MemoryDriverStore)
+    sim.submit('u1', 'A', 'C')  # pairs with u0, then every claim fails
+
+    assert {r['userId'] for r in sim.requests} == {'u0', 'u1'}
+    assert sim.drivers[0]['status'] == 'idle' and len(sim.history) == 0
+
+
+def test_failed_commit_restores_the_package_simulator(monkeypatch):
+    sim = package.CarpoolSimulator()
+    before = [dict(d) for d in sim.drivers]
+    fail_commits(monkeypatch, MemoryDriverStore)
+    res = sim.submit_request('u1', 'A', 'C')
+
+    assert not res['success']
+    assert sim.drivers == before and len(sim.history) == 0
+    assert sim._sync() == {d['id']: 1 for d in before}
+
+
+def test_stores_must_implement_the_whole_interface():
+    class Partial(DriverStore):
+        def seed(self, drivers): pass
+    with pytest.raises(TypeError):
+        Partial()
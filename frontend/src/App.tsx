@@ -53,6 +53,7 @@ interface Message {
 }
 
 const API_BASE_URL = "http://127.0.0.1:5000";
+const HISTORY_LIMIT = 200; // matches the server's in-memory history; older rides are under /history
 
 export default function App() {
   const [graphData, setGraphData] = useState<GraphData>({ nodes: [], edges: [] });
@@ -66,18 +67,67 @@ export default function App() {
   const [message, setMessage] = useState<Message | null>(null);
   const [selectionMode, setSelectionMode] = useState<"source" | "dest">("source");
 
+  // version of the last /status snapshot applied; null until the first full load
+  const versionRef = useRef<number | null>(null);
+
   useEffect(() => {
-    fetchStatus();
+    // initial snapshot over HTTP, then live deltas pushed by the backend over server-sent events
+    let source: EventSource | null = null;
+    let closed = false;
+    fetchStatus().then(() => {
+      if (closed) return;
+      source = new EventSource(`${API_BASE_URL}/events?since=${versionRef.current ?? 0}`);
+      source.addEventListener("delta", (e) => applyDelta(JSON.parse((e as MessageEvent).data)));
+    });
+    return () => {
+      closed = true;
+      source?.close();
+    };
   }, []);
 
+  const applyDelta = (data: any) => {
+    const current = versionRef.current;
+    if (current !== null && data.version <= current) return; // already applied
+    if (current !== null && data.since > current) {
+      fetchStatus(); // missed some changes; resync from our version
+      return;
+    }
+    if (data.reset) {
+      // we were too far behind for a delta: the backend sent its whole state instead
+      setDrivers(data.drivers);
+      setRequests(data.requests.added);
+      setRideHistory(data.rideHistory);
+      versionRef.current = data.version;
+      return;
+    }
+    const changed = new Map<string, Driver>(data.drivers.map((d: Driver) => [d.id, d]));
+    setDrivers((prev) => prev.map((d) => changed.get(d.id) ?? d));
+    setRequests((prev) => [
+      ...prev.filter((r) => !data.requests.removed.includes(r.id)),
+      ...data.requests.added,
+    ]);
+    setRideHistory((prev) => [...prev, ...data.rideHistory].slice(-HISTORY_LIMIT));
+    versionRef.current = data.version;
+  };
+
   const fetchStatus = async () => {
     try {
-      const res = await fetch(`${API_BASE_URL}/status`);
+      const since = versionRef.current;
+      if (since === null) {
+        const graphRes = await fetch(`${API_BASE_URL}/graph`);
+        const graph = await graphRes.json();
+        setGraphData({ nodes: graph.nodes, edges: graph.edges });
+      }
+      const res = await fetch(`${API_BASE_URL}/status?since=${since ?? 0}`);
       const data = await res.json();
-      setGraphData({ nodes: data.nodes, edges: data.edges });
-      setDrivers(data.drivers);
-      setRequests(data.requests);
-      setRideHistory(data.rideHistory);
+      if (since === null) {
+        setDrivers(data.drivers);
+        setRequests(data.requests.added);
+        setRideHistory(data.rideHistory);
+        versionRef.current = data.version;
+      } else {
+        applyDelta(data);
+      }
     } catch (error) {
       setMessage({ success: false, text: "Cannot connect to backend." });
     }
@@ -111,7 +161,6 @@ export default function App() {
     const data = await res.json();
     setMessage({ success: data.success, text: data.message });
     if (data.assigned_route) setCurrentRoute(data.assigned_route);
-    fetchStatus();
     setUserId("");
     setSelectedSource(null);
     setSelectedDest(null);
@@ -125,7 +174,6 @@ export default function App() {
     });
     const data = await res.json();
     setMessage({ success: data.success, text: data.message });
-    fetchStatus();
   };
 
   const getNodeName = (id: string | null) => {